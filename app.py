@@ -1,9 +1,21 @@
 """ doc """
-from time import sleep
+from time import perf_counter
 import sys
 from PyQt5.QtWidgets import *
-from libcpu import DRCv2System
-from PyQt5.QtCore import QTimer
+from libcpu import DRCv2System, WORD_SIZES
+from appmodels import MemoryModel, RomModel, RegisterModel, CounterModel
+from appworker import EmulatorWorker
+from libcompiler import DEVICES, CompileError
+from libdebug import parse_point, describe, BREAK_PC, WATCH_READ, WATCH_WRITE
+from libprofile import rom_labels
+from PyQt5.QtCore import QTimer, QThread
+
+
+# Screen refreshes per second while the clock is running.
+FRAME_RATE = 30
+
+# Seconds between updates of the measured frequency.
+FREQ_WINDOW = 0.5
 
 
 class App(QMainWindow):
@@ -13,10 +25,15 @@ class App(QMainWindow):
         super().__init__()
 
         self.run = False
-        self.program = []
-        self.total_clk = 0
+        self.freq_time = perf_counter()
+        self.freq_cycles = 0
         self.filename = "programs/mod_calc.a"
+        self.word_size = 8
+        self.seed = None
         self.old_mem_map = []
+        # Breakpoints as typed, set again on every reset and ROM load.
+        self.break_specs = []
+        self.labels = {}
 
         ######################
         # Creation of window elements
@@ -39,39 +56,71 @@ class App(QMainWindow):
 
         # actions
         load_rom = QAction('Load program to ROM', self)
+        load_input = QAction('Load console input', self)
         reset_system = QAction('Reset system', self)
+        reset_counters = QAction('Reset counters', self)
         exit_program = QAction('Exit', self)
 
         # Clock controls.
         step_btn = QPushButton('Step', self)
+        step_back_btn = QPushButton('Step back', self)
+        self.rewind_box = QSpinBox(self)
+        rewind_btn = QPushButton('Rewind to cycle', self)
+        self.break_in = QLineEdit(self)
+        break_btn = QPushButton('Add breakpoint', self)
+        clear_break_btn = QPushButton('Clear breakpoints', self)
         self.start_btn = QPushButton('Start', self)
         self.stop_btn = QPushButton('Stop', self)
         self.freq_box = QDoubleSpinBox(self)
+        self.turbo_box = QCheckBox('Turbo', self)
+        self.counters_box = QCheckBox('Counters', self)
+        self.history_box = QCheckBox('Record history', self)
+        self.word_box = QComboBox(self)
+        self.seed_box = QSpinBox(self)
         self.clk_count = QLineEdit(self)
+        self.freq_out = QLineEdit(self)
+        clk_layout = QHBoxLayout()
 
         # Console.
         self.console_out = QLineEdit(self)
         self.console_in = QLineEdit(self)
         enter_btn = QPushButton('Enter', self)
 
+        # Back-end, the tables below are views onto it.
+        self.initialize_core()
+        self.core_model = MemoryModel(self.sys0, self)
+        self.reg_model = RegisterModel(self.sys0, self)
+        self.rom_model = RomModel(self.sys0, self)
+        self.counter_model = CounterModel(self.sys0, self)
+
         # Core memory cell table.
-        self.core_table = QTableWidget(self)
-        self.core_table.setColumnCount(1)
-        self.core_table.setRowCount(192)
+        self.core_table = QTableView(self)
+        self.core_table.setModel(self.core_model)
 
-        # Registers table.
-        self.reg_table = QTableWidget(self)
-        self.reg_table.setRowCount(10)  # 8 gpr-s, pc and status reg.
-        self.reg_table.setColumnCount(1)
+        # Registers table, 8 gpr-s, pc and status reg.
+        self.reg_table = QTableView(self)
+        self.reg_table.setModel(self.reg_model)
 
         # ROM table.
-        self.rom_table = QTableWidget(self)
-        self.rom_table.setRowCount(256)
-        self.rom_table.setColumnCount(1)
-
-        # Clock
-        self.clock = QTimer()
-        self.clock.timeout.connect(self.step)
+        self.rom_table = QTableView(self)
+        self.rom_table.setModel(self.rom_model)
+
+        # Performance counters table.
+        self.counter_table = QTableView(self)
+        self.counter_table.setModel(self.counter_model)
+
+        # Clock, runs the system on its own thread.
+        self.worker = EmulatorWorker(self.sys0)
+        self.clock = QThread(self)
+        self.worker.moveToThread(self.clock)
+        self.clock.started.connect(self.worker.run_clock)
+        self.worker.finished.connect(self.clock.quit)
+        self.worker.halted.connect(self.stop)
+        self.worker.stopped_at_break.connect(self.on_break)
+
+        # Screen refresh, independent of the emulated clock.
+        self.frame_timer = QTimer()
+        self.frame_timer.timeout.connect(self.update_contents)
 
         ######################
         # stacking them together
@@ -94,15 +143,31 @@ class App(QMainWindow):
 
         # Central layout.
         c_layout.addWidget(self.freq_box)
+        c_layout.addWidget(self.turbo_box)
+        c_layout.addWidget(self.counters_box)
+        c_layout.addWidget(self.history_box)
+        c_layout.addWidget(self.word_box)
+        c_layout.addWidget(self.seed_box)
         c_layout.addWidget(self.start_btn)
         c_layout.addWidget(self.stop_btn)
         c_layout.addWidget(step_btn)
-        c_layout.addWidget(self.clk_count)
+        c_layout.addWidget(step_back_btn)
+        c_layout.addWidget(self.rewind_box)
+        c_layout.addWidget(rewind_btn)
+        c_layout.addWidget(self.break_in)
+        c_layout.addWidget(break_btn)
+        c_layout.addWidget(clear_break_btn)
+        clk_layout.addWidget(self.clk_count)
+        clk_layout.addWidget(self.freq_out)
+        c_layout.addLayout(clk_layout)
         c_layout.addWidget(self.reg_table)
+        c_layout.addWidget(self.counter_table)
 
         # Bar
         fileMenu.addAction(load_rom)
+        fileMenu.addAction(load_input)
         fileMenu.addAction(reset_system)
+        fileMenu.addAction(reset_counters)
         fileMenu.addAction(exit_program)
 
         ######################
@@ -110,36 +175,41 @@ class App(QMainWindow):
         ######################
         self.setGeometry(100, 100, 600, 600)
 
-        # set max value for spinbox.
-        self.freq_box.setMaximum(50)
+        # set range for spinbox, in Hz.
+        self.freq_box.setMinimum(1)
+        self.freq_box.setMaximum(10**7)
 
         # initialize spinbox with some reasonable value.
         self.freq_box.setValue(50)
 
-        # Properly label memory table.
-        tab = []
-        for i in range(192):
-            tab.append("cell " + str(i))
-        self.core_table.setVerticalHeaderLabels(tab)
-        self.core_table.setHorizontalHeaderLabels(["Core memory"])
-
-        # Properly ROM table.
-        tab = []
-        for i in range(256):
-            tab.append(str(i))
-        self.rom_table.setVerticalHeaderLabels(tab)
-        self.rom_table.setHorizontalHeaderLabels(["Program memory"])
-
-        # Properly label register table.
-        tab = ["R0", "R1", "R2", "R3", "R4", "R5", "R6", "SP", "PC", "ST"]
-        self.reg_table.setVerticalHeaderLabels(tab)
-        self.reg_table.setHorizontalHeaderLabels(["Registers"])
+        # Readouts are not editable.
+        self.clk_count.setReadOnly(True)
+        self.freq_out.setReadOnly(True)
+
+        # Word size of the emulated machine, changing it resets the system.
+        for bits in WORD_SIZES:
+            self.word_box.addItem(f"{bits} bit words", bits)
+
+        self.break_in.setPlaceholderText("[read|write] addr/.label [if R1 == 0]")
+
+        # RNG seed, the lowest value stands for a new random seed per reset.
+        self.seed_box.setMinimum(-1)
+        self.seed_box.setMaximum(2**31 - 1)
+        self.seed_box.setSpecialValueText("Random seed")
+        self.seed_box.setPrefix("Seed ")
+        self.seed_box.setValue(-1)
+
+        # Any cycle can be asked for, history decides what is reachable.
+        self.rewind_box.setMaximum(2**31 - 1)
 
         # Resize register table.
         self.core_table.setColumnWidth(0, 117)
         self.reg_table.setColumnWidth(0, 166)
         self.rom_table.setColumnWidth(0, 145)
+        self.counter_table.setColumnWidth(0, 100)
 
+        # Counters are a step hook and cost the fast paths, shown on demand.
+        self.counter_table.setVisible(False)
 
         # Set stop button as pushed down,
         # because initially there is nothing to stop.
@@ -150,140 +220,294 @@ class App(QMainWindow):
         ######################
         exit_program.triggered.connect(self.exit_program)
         reset_system.triggered.connect(self.reset)
+        reset_counters.triggered.connect(self.reset_counters)
         load_rom.triggered.connect(self.load)
+        load_input.triggered.connect(self.load_input)
 
         step_btn.clicked.connect(self.step)
+        step_back_btn.clicked.connect(self.step_back)
+        rewind_btn.clicked.connect(self.rewind)
+        break_btn.clicked.connect(self.add_breakpoint)
+        self.break_in.returnPressed.connect(self.add_breakpoint)
+        clear_break_btn.clicked.connect(self.clear_breakpoints)
+        self.rom_table.doubleClicked.connect(self.toggle_breakpoint)
         self.start_btn.clicked.connect(self.start)
         self.stop_btn.clicked.connect(self.stop)
+        self.freq_box.valueChanged.connect(self.set_frequency)
+        self.turbo_box.toggled.connect(self.set_turbo)
+        self.counters_box.toggled.connect(self.set_counters)
+        self.history_box.toggled.connect(self.set_history)
+        self.word_box.currentIndexChanged.connect(self.set_word_size)
+        self.seed_box.valueChanged.connect(self.set_seed)
 
         enter_btn.clicked.connect(self.cons_enter)
 
         ######################
 
-        self.initialize_core()
         self.show()
 
     ######################
     # methods
     ######################
 
-    # Write user input into console buffer.
+    # Queue user input for the console.
     def cons_enter(self):
         val = self.console_in.text()
         if val:
             val = int(val)
         #  if val != "":
-            self.sys0.devices[2].write(val)
-        self.sys0.status_reg["wait_bit"] = False
+            with self.worker.lock:
+                self.sys0.devices[2].push(val)
+
+    # Queue console input from a text file.
+    def load_input(self):
+        options = QFileDialog.Options()
+        filename, _ = QFileDialog.getOpenFileName(self,
+                                "Select file...", "", options=options)
+        if filename:
+            try:
+                with self.worker.lock:
+                    self.sys0.devices[2].feed_file(filename)
+            except (OSError, ValueError) as err:
+                # e.g. a binary file or one with a word that isn't a number.
+                self.statusBar().showMessage(f"{filename}: {err}")
 
     # Load program.
     def load(self):
         options = QFileDialog.Options()
         self.filename, _ = QFileDialog.getOpenFileName(self,
-                                "Select file...", "", options=options)
+                                "Select file...", "",
+                                "ROM files (*.a *.drb);;All files (*)",
+                                options=options)
         self.reset()
         self.update_contents()
 
     # Start clock
     def start(self):
-        period = (1/self.freq_box.value())*1000
-        period = int(period)
-        self.clock.start(period)
+        self.set_frequency(self.freq_box.value())
+        self.set_turbo(self.turbo_box.isChecked())
+        self.clock.start()
+        self.frame_timer.start(1000 // FRAME_RATE)
         self.start_btn.setEnabled(False)
         self.stop_btn.setEnabled(True)
 
     # Stop clock.
     def stop(self):
-        self.clock.stop()
+        self.worker.stop()
+        self.clock.quit()
+        self.clock.wait()
+        self.frame_timer.stop()
+        self.update_contents()
         self.start_btn.setEnabled(True)
         self.stop_btn.setEnabled(False)
 
+    def set_frequency(self, value):
+        self.worker.set_frequency(value)
+
+    def set_turbo(self, checked):
+        self.worker.set_turbo(checked)
+        self.freq_box.setEnabled(not checked)
+
+    # Counting runs every instruction through the step hooks.
+    def set_counters(self, checked):
+        with self.worker.lock:
+            if checked:
+                self.sys0.enable_counters()
+            else:
+                self.sys0.disable_counters()
+        self.counter_table.setVisible(checked)
+        self.update_contents()
+
+    # Recording is a step hook too, Step back and Rewind need it.
+    def set_history(self, checked):
+        with self.worker.lock:
+            if checked:
+                self.sys0.enable_history()
+            else:
+                self.sys0.disable_history()
+
+    def set_word_size(self, index):
+        self.word_size = self.word_box.itemData(index)
+        self.reset()
+
+    def set_seed(self, value):
+        self.seed = None if value < 0 else value
+        self.reset()
+
     def step(self):
-        self.sys0.get_next_state()
+        with self.worker.lock:
+            self.sys0.get_next_state()
         #  if self.sys0.program_counter
         self.update_contents()
         if self.sys0.status_reg["halt_bit"] == True:
             self.stop()
 
+    # Undo the last instruction.
+    def step_back(self):
+        try:
+            with self.worker.lock:
+                self.sys0.step_back()
+        except ValueError as err:
+            self.statusBar().showMessage(str(err))
+        self.update_contents()
+
+    # Move to the cycle chosen in rewind_box.
+    def rewind(self):
+        try:
+            with self.worker.lock:
+                self.sys0.goto_cycle(self.rewind_box.value())
+        except ValueError as err:
+            self.statusBar().showMessage(str(err))
+        self.update_contents()
+
+    # Zero the performance counters, e.g. between two phases of a program.
+    def reset_counters(self):
+        with self.worker.lock:
+            if self.sys0.counters is not None:
+                self.sys0.counters.reset()
+        self.update_contents()
+
+    # Set the breakpoint typed into break_in.
+    def add_breakpoint(self):
+        spec = self.break_in.text().strip()
+        if not spec:
+            return
+        try:
+            point = parse_point(spec, self.labels, DEVICES,
+                                self.word_size)
+            with self.worker.lock:
+                self.sys0.get_breakpoints().add(*point)
+        except ValueError as err:
+            self.statusBar().showMessage(str(err))
+            return
+        self.break_specs.append(spec)
+        self.break_in.clear()
+        self.statusBar().showMessage(f"Breakpoint set: {spec}")
+        self.rom_model.layoutChanged.emit()
+
+    # Double click on a ROM row sets or clears a breakpoint there.
+    def toggle_breakpoint(self, index):
+        addr = index.row()
+        with self.worker.lock:
+            points = self.sys0.get_breakpoints()
+            if points.toggle(BREAK_PC, addr):
+                self.break_specs.append(str(addr))
+            else:
+                self.break_specs = [spec for spec in self.break_specs
+                                    if not self.is_pc_spec(spec, addr)]
+        self.rom_model.dataChanged.emit(index, index)
+
+    def is_pc_spec(self, spec, addr):
+        try:
+            kind, point_addr, _ = parse_point(spec, self.labels, DEVICES,
+                                              self.word_size)
+        except ValueError:
+            return False
+        return kind == BREAK_PC and point_addr == addr
+
+    def clear_breakpoints(self):
+        self.break_specs = []
+        with self.worker.lock:
+            self.sys0.get_breakpoints().clear()
+        self.rom_model.layoutChanged.emit()
+
+    # The clock ran into a breakpoint or watchpoint: stop and show where.
+    def on_break(self):
+        self.stop()
+        hit = self.sys0.breakpoints.hit
+        self.statusBar().showMessage("Stopped at "
+                                     + describe(hit, self.labels))
+        if hit.kind in (WATCH_READ, WATCH_WRITE) \
+                and hit.addr >= self.sys0.heap_start:
+            self.core_table.selectRow(hit.addr - self.sys0.heap_start)
+
     def reset(self):
+        self.stop()
         del self.sys0
-        self.total_clk = 0
         self.initialize_core()
+        self.worker.system = self.sys0
+        self.freq_cycles = 0
+        for model in (self.core_model, self.reg_model, self.rom_model,
+                      self.counter_model):
+            model.set_system(self.sys0)
         self.update_contents()
 
     # initialize back-end
     def initialize_core(self):
         """ Start application back-end. """
-        self.sys0 = DRCv2System()
-        self.sys0.load_rom(self.filename)
-
-        with open(self.filename, "r") as f:
-            self.program = []
-            for line in f:
-                self.program.append(line.strip())
+        self.sys0 = DRCv2System(self.word_size, seed=self.seed)
+        if self.history_box.isChecked():
+            self.sys0.enable_history()
+        if self.counters_box.isChecked():
+            self.sys0.enable_counters()
+        try:
+            self.sys0.load_rom(self.filename)
+        except ValueError as err:
+            # e.g. a ROM built for a wider word size.
+            self.statusBar().showMessage(str(err))
+        try:
+            self.labels = rom_labels(self.filename, self.sys0.program,
+                                     word_size=self.word_size)
+        except ValueError as err:
+            # Labels of a stale source would point at the wrong code.
+            self.statusBar().showMessage(f"{err}, labels unavailable")
+            self.labels = {}
+        except (OSError, CompileError):
+            self.labels = {}
+        points = self.sys0.get_breakpoints()
+        for spec in self.break_specs:
+            try:
+                points.add(*parse_point(spec, self.labels, DEVICES,
+                                        self.word_size))
+            except ValueError as err:
+                self.statusBar().showMessage(f"{spec}: {err}")
 
     # update contents
     def update_contents(self):
         """ Update back-end state with new parameters. """
 
-        # Fill core memory table.
-        mem_tab = []
-        for i in range(64, 256):
-            if self.sys0.registers[7] == i:
-                mem_tab.append(str(self.sys0.devices[i].val) + "   <-- SP")
-            else:
-                mem_tab.append(str(self.sys0.devices[i].val))
-
-        for i in range(len(mem_tab)):
-            self.core_table.setItem(i, 0, QTableWidgetItem(mem_tab[i]))
-
-        if self.sys0.last_written:
-            last_written = self.sys0.last_written - 64
-            self.core_table.selectRow(last_written)
-
-
-        # Fill ROM display table.
-        # Display an arrow pointing on the next instruction.
-        tab = []
-        for i in range(len(self.program)):
-            #  if i == self.sys0.program_counter:
-                #  tab.append(self.program[i] + "    <--")
-            #  else:
-            tab.append(self.program[i])
-
-        for i in range(len(tab)):
-            self.rom_table.setItem(i, 0, QTableWidgetItem(tab[i]))
+        # Snapshot everything in one go, the clock may be running.
+        with self.worker.lock:
+            # Redraw only the cells that changed.
+            self.core_model.refresh()
+            self.reg_model.refresh()
+            self.counter_model.refresh()
+            last_written = self.sys0.last_written
+            program_counter = self.sys0.program_counter
+            console = self.sys0.devices[2].last()
+            cycles = self.sys0.cycles
+            waited = self.sys0.waited()
 
-        self.rom_table.selectRow(self.sys0.program_counter)
+        if last_written:
+            self.core_table.selectRow(last_written - self.sys0.heap_start)
 
-        # Print out registers.
-        for i in range(len(self.sys0.registers)):
-            self.reg_table.setItem(i, 0, QTableWidgetItem(str(self.sys0.registers[i])))
-        self.reg_table.setItem(8, 0, QTableWidgetItem(str(self.sys0.program_counter)))
-
-        status_str = "h: "
-        status_str += str(self.sys0.status_reg["halt_bit"])
-        status_str += " c: "
-        status_str += str(self.sys0.status_reg["carry_flag"])
-        status_str += " z: "
-        status_str += str(self.sys0.status_reg["zero_flag"])
-        self.reg_table.setItem(9, 0, QTableWidgetItem(status_str))
-
-        # Resize register table.
-        #  self.reg_table.resizeColumnsToContents()
+        self.rom_table.selectRow(program_counter)
 
         # Display console buffer contents.
-        self.console_out.setText(str(self.sys0.devices[2].buffer[0]))
+        self.console_out.setText(str(console))
 
         # Display total clock cycles.
-        self.clk_count.setText(f"Clock ticks: {self.total_clk}")
-        self.total_clk += 1
+        self.clk_count.setText(f"Clock ticks: {cycles}, "
+                               f"waited {waited:.1f} s")
+
+        # Display the measured clock frequency.
+        now = perf_counter()
+        if now - self.freq_time >= FREQ_WINDOW:
+            freq = (cycles - self.freq_cycles) / (now - self.freq_time)
+            self.freq_out.setText(f"{freq:.0f} Hz")
+            self.freq_time = now
+            self.freq_cycles = cycles
 
     # exit
     def exit_program(self):
         """ Gracefully terminate app. """
+        self.stop()
         sys.exit(0)
 
+    def closeEvent(self, event):
+        self.stop()
+        super().closeEvent(event)
+
     # Prompt user for console input.
     def prompt(self):
         val, ok = QInputDialog().getInt(self, "Console",
@@ -0,0 +1,214 @@
+""" Qt table models showing the state of a DRCv2System.
+
+The views only paint what they show from a snapshot the models take in
+refresh(), so the emulator can keep running on another thread while the
+GUI repaints. refresh() also tells the views which rows changed since the
+previous refresh: memory rows come from the emulator's dirty cells, the
+handful of register rows are compared against what was last shown.
+"""
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex
+
+from libcpu import disassemble
+from libcounters import COUNTERS
+from libdebug import BREAK_PC
+
+
+class SystemModel(QAbstractTableModel):
+    """ Single column table model bound to a DRCv2System. """
+    title = ""
+
+    def __init__(self, system, parent=None):
+        super().__init__(parent)
+        self.system = system
+
+    def set_system(self, system):
+        """ Point the model at another system, e.g. after a reset. """
+        self.beginResetModel()
+        self.system = system
+        self.reload()
+        self.endResetModel()
+
+    def reload(self):
+        """ Refresh cached data, called inside a model reset. """
+
+    def columnCount(self, parent=QModelIndex()):
+        return 1
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return self.title
+        return self.row_label(section)
+
+    def row_label(self, row):
+        """ Vertical header text. """
+        return str(row)
+
+    def rows_changed(self, rows):
+        """ Emit dataChanged once per run of consecutive rows. """
+        start = prev = None
+        for row in sorted(rows):
+            if start is None:
+                start = prev = row
+            elif row == prev + 1:
+                prev = row
+            else:
+                self.dataChanged.emit(self.index(start, 0), self.index(prev, 0))
+                start = prev = row
+        if start is not None:
+            self.dataChanged.emit(self.index(start, 0), self.index(prev, 0))
+
+
+class MemoryModel(SystemModel):
+    """ RAM cells above the heap start, with the stack pointer marked.
+    Row counts follow the word size of the system. """
+    title = "Core memory"
+
+    def __init__(self, system, parent=None):
+        super().__init__(system, parent)
+        self.cells = []
+        self.stack_row = None
+        self.reload()
+
+    def reload(self):
+        self.system.take_dirty()
+        self.cells = self.system.ram.tolist()
+        self.stack_row = self.system.registers[7] - self.system.heap_start
+
+    def rowCount(self, parent=QModelIndex()):
+        return len(self.cells)
+
+    def row_label(self, row):
+        return "cell " + str(row)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        text = str(self.cells[index.row()])
+        if index.row() == self.stack_row:
+            text += "   <-- SP"
+        return text
+
+    def refresh(self):
+        """ Snapshot the memory and announce the cells written since the
+        last refresh. """
+        start = self.system.heap_start
+        rows = {addr - start for addr in self.system.take_dirty()
+                if addr >= start}
+        self.cells = self.system.ram.tolist()
+        stack_row = self.system.registers[7] - start
+        if stack_row != self.stack_row:
+            rows.update(row for row in (stack_row, self.stack_row)
+                        if 0 <= row < len(self.cells))
+            self.stack_row = stack_row
+        self.rows_changed(rows)
+
+
+class RomModel(SystemModel):
+    """ Disassembled program memory, built once per ROM load, with the
+    breakpoints marked. """
+    title = "Program memory"
+
+    def __init__(self, system, parent=None):
+        super().__init__(system, parent)
+        self.lines = []
+        self.reload()
+
+    def reload(self):
+        self.lines = [disassemble(ins) for ins in self.system.program]
+
+    def rowCount(self, parent=QModelIndex()):
+        return len(self.lines)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        points = self.system.breakpoints
+        if points is not None and points.flags[BREAK_PC][index.row()]:
+            return self.lines[index.row()] + "   <-- break"
+        return self.lines[index.row()]
+
+
+class RegisterModel(SystemModel):
+    """ General purpose registers, PC and status register. """
+    title = "Registers"
+    labels = ["R0", "R1", "R2", "R3", "R4", "R5", "R6", "SP", "PC", "ST"]
+
+    def __init__(self, system, parent=None):
+        super().__init__(system, parent)
+        self.shown = []
+        self.reload()
+
+    def reload(self):
+        self.shown = self.values()
+
+    def values(self):
+        """ Display text of every row. """
+        system = self.system
+        status = system.status_reg
+        status_str = "h: " + str(status["halt_bit"]) \
+            + " c: " + str(status["carry_flag"]) \
+            + " z: " + str(status["zero_flag"])
+        return [str(reg) for reg in system.registers] \
+            + [str(system.program_counter), status_str]
+
+    def rowCount(self, parent=QModelIndex()):
+        return len(self.labels)
+
+    def row_label(self, row):
+        return self.labels[row]
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        return self.shown[index.row()]
+
+    def refresh(self):
+        """ Announce the rows whose text changed. """
+        values = self.values()
+        rows = [i for i, (old, new) in enumerate(zip(self.shown, values))
+                if old != new]
+        self.shown = values
+        self.rows_changed(rows)
+
+
+class CounterModel(SystemModel):
+    """ Performance counters of the system, empty while they are off. """
+    title = "Counters"
+
+    def __init__(self, system, parent=None):
+        super().__init__(system, parent)
+        self.shown = []
+        self.reload()
+
+    def reload(self):
+        self.shown = self.values()
+
+    def values(self):
+        counters = self.system.counters
+        return [] if counters is None else counters.block.tolist()
+
+    def rowCount(self, parent=QModelIndex()):
+        return len(self.shown)
+
+    def row_label(self, row):
+        return COUNTERS[row]
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        return str(self.shown[index.row()])
+
+    def refresh(self):
+        """ Announce the counters that moved. """
+        values = self.values()
+        if len(values) != len(self.shown):
+            self.beginResetModel()
+            self.shown = values
+            self.endResetModel()
+            return
+        rows = [i for i, (old, new) in enumerate(zip(self.shown, values))
+                if old != new]
+        self.shown = values
+        self.rows_changed(rows)
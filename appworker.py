@@ -0,0 +1,97 @@
+""" Background clock for the GUI.
+
+EmulatorWorker lives on its own QThread and runs the system in batches of
+cycles, paced to a target frequency or as fast as possible in turbo mode.
+Every access to the system, from the worker or from the GUI, goes through
+worker.lock so the GUI can take a consistent snapshot between two batches.
+While the program waits for console input the thread sleeps until the
+console's on_ready() callback or stop() wakes it up.
+"""
+import threading
+from time import perf_counter, sleep
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from libcpu import EXIT_HALT, EXIT_WAIT, EXIT_BREAK
+
+
+# Most cycles run while holding the lock, keeps the GUI responsive.
+MAX_BATCH = 10000
+
+# Longest nap between batches.
+MAX_SLEEP = 0.02
+
+
+class EmulatorWorker(QObject):
+    """ Runs a DRCv2System until stopped, halted or out of cycles. """
+    halted = pyqtSignal()
+    stopped_at_break = pyqtSignal()
+    finished = pyqtSignal()
+
+    def __init__(self, system, frequency=50):
+        super().__init__()
+        self.system = system
+        self.frequency = frequency
+        self.turbo = False
+        self.running = False
+        self.resync = True
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+
+    def stop(self):
+        """ Ask the clock loop to finish after the current batch. """
+        self.running = False
+        self.wake.set()
+
+    def set_frequency(self, frequency):
+        """ Change the target frequency in Hz, also while running. """
+        self.frequency = frequency
+        self.resync = True
+
+    def set_turbo(self, turbo):
+        """ Run uncapped instead of at the target frequency. """
+        self.turbo = bool(turbo)
+        self.resync = True
+
+    def run_clock(self):
+        """ Clock loop, connected to QThread.started. """
+        self.running = True
+        self.resync = True
+        while self.running:
+            if self.resync:
+                self.resync = False
+                start = perf_counter()
+                done = 0
+
+            if self.turbo:
+                batch = MAX_BATCH
+            else:
+                elapsed = perf_counter() - start
+                batch = int(elapsed * self.frequency) - done
+                if batch <= 0:
+                    sleep(min((done + 1) / self.frequency - elapsed, MAX_SLEEP))
+                    continue
+                if batch > MAX_BATCH:
+                    # Falling behind, drop the backlog instead of bursting.
+                    batch = MAX_BATCH
+                    self.resync = True
+
+            with self.lock:
+                reason, cycles = self.system.run(max_cycles=batch)
+            done += cycles
+
+            if reason == EXIT_HALT:
+                self.running = False
+                self.halted.emit()
+            elif reason == EXIT_BREAK:
+                self.running = False
+                self.stopped_at_break.emit()
+            elif reason == EXIT_WAIT:
+                self.wake.clear()
+                with self.lock:
+                    self.system.on_ready(self.wake.set)
+                if self.running:
+                    self.wake.wait()
+                # Don't catch up on the time spent waiting for input.
+                self.resync = True
+        self.finished.emit()
@@ -0,0 +1,80 @@
+""" Compile time of libcompiler on machine generated sources.
+
+    python bench_compiler.py [max lines]
+
+Writes synthetic programs of doubling size, with labels, macros, calls
+and comments, to a temporary directory and times compile_file() on each.
+The time per line should stay flat as the sources grow. The cached
+column is a repeat compile served by a CompileCache. The programs are
+compiled for WORD_SIZE bit words, their labels don't fit in 8 bits, and
+the default max lines is the largest size whose code fits that ROM.
+"""
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+from libcompiler import compile_file, CompileCache
+
+
+WORD_SIZE = 16
+
+# One generated block, about 16 source lines.
+BLOCK = """\
+.block_{n} // block {n}
+IMM R1 {n}
+LOD R2 %RNG
+ADD R3 R1 R2
+PSH R3
+CAL .sub_{n}
+POP R4
+BRZ .skip_{n} R4
+STR #{slot} R4 ; spill
+.skip_{n}
+BRL .block_{n} R1 R2
+MOV R5 R4
+JMP .next_{n}
+.sub_{n}
+RSH R2 R2
+RET
+.next_{n}
+"""
+
+
+def generate(filename, lines):
+    """ Write a source file of at least lines lines. """
+    with open(filename, "w") as f:
+        n = 0
+        written = 0
+        while written < lines:
+            block = BLOCK.format(n=n, slot=n % 64)
+            f.write(block)
+            written += block.count("\n")
+            n += 1
+        f.write("HLT\n")
+        return written + 1
+
+
+def main(max_lines=32768):
+    print(f"{'lines':>8} {'instructions':>13} {'seconds':>9} {'us/line':>8} "
+          f"{'cached':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = CompileCache(os.path.join(tmp, "cache"))
+        size = 1024
+        while size <= max_lines:
+            filename = os.path.join(tmp, f"gen_{size}.s")
+            lines = generate(filename, size)
+            start = perf_counter()
+            program = compile_file(filename, tmp, word_size=WORD_SIZE)
+            elapsed = perf_counter() - start
+            compile_file(filename, tmp, cache=cache, word_size=WORD_SIZE)
+            start = perf_counter()
+            compile_file(filename, tmp, cache=cache, word_size=WORD_SIZE)
+            cached = perf_counter() - start
+            print(f"{lines:>8} {len(program.lines):>13} {elapsed:>9.4f} "
+                  f"{elapsed / lines * 1e6:>8.2f} {cached:>9.4f}")
+            size *= 2
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,73 @@
+""" Static and measured savings of the peephole optimizer.
+
+    python bench_optimizer.py
+
+Compiles every sample program with and without liboptimizer, runs both
+ROMs in the emulator with the same console input and RNG seed, checks
+they print the same and compares instruction counts and cycles.
+"""
+import os
+import sys
+import tempfile
+
+from libcompiler import compile_file, save_file, DEVICES
+from libcpu import DRCv2System, load_program, CONSOLE_ADDR
+
+
+MAX_CYCLES = 1000000
+SEED = 1
+
+# source, library directory, console input
+SAMPLES = [
+    ("programs/bubble_sort.s", "programs/", []),
+    ("programs/calc_gcd.s", "programs/", []),
+    ("programs/mod_calc.s", "programs/", [17, 5]),
+    ("programs/stack_overflow.s", "programs/", []),
+    ("source_files/bubble_sort_i.s", "source_files/",
+     [9, 4, 7, 1, 8, 2, 6, 3, 5, 0]),
+]
+
+
+def run(lines, inputs, tmp):
+    """ (exit reason, cycles, console output) of a compiled program. """
+    filename = os.path.join(tmp, "bench.a")
+    save_file(filename, lines)
+    system = DRCv2System(seed=SEED)
+    system.program = load_program(system.word_size, filename)
+    console = system.devices[CONSOLE_ADDR]
+    console.feed(inputs)
+    reason, cycles = system.run(max_cycles=MAX_CYCLES)
+    return reason, cycles, list(reversed(console.buffer))
+
+
+def main():
+    print(f"{'program':<30} {'instructions':>14} {'cycles':>16} {'saved':>7}")
+    totals = [0, 0, 0, 0]
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        for source, libdir, inputs in SAMPLES:
+            plain = compile_file(source, libdir, DEVICES)
+            optimized = compile_file(source, libdir, DEVICES, optimize=True)
+            before = run(plain.lines, inputs, tmp)
+            after = run(optimized.lines, inputs, tmp)
+            if (before[0], before[2]) != (after[0], after[2]):
+                print(f"{source}: optimized program behaves differently")
+                failed = True
+                continue
+            counts = [len(plain.lines), len(optimized.lines),
+                      before[1], after[1]]
+            totals = [total + count for total, count in zip(totals, counts)]
+            print(f"{source:<30} {counts[0]:>6} -> {counts[1]:<5} "
+                  f"{counts[2]:>7} -> {counts[3]:<6} "
+                  f"{1 - counts[3] / counts[2]:>7.1%}")
+            applied = ", ".join(f"{name} {count}" for name, count
+                                in optimized.optimizations.items() if count)
+            print(f"    {applied}")
+    print(f"{'total':<30} {totals[0]:>6} -> {totals[1]:<5} "
+          f"{totals[2]:>7} -> {totals[3]:<6} "
+          f"{1 - totals[3] / max(totals[2], 1):>7.1%}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
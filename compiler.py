@@ -1,37 +1,63 @@
-""" DRCv2 compiler main script. """
+""" DRCv2 compiler main script.
 
-from libcompiler import *
+    python compiler.py [-O] [-b] [-w BITS] [name]
+compiles programs/<name>.s into programs/<name>.a, -O runs the peephole
+optimizer, -b writes a binary programs/<name>.drb with a symbol table
+instead. -w compiles for a 12 or 16 bit system, the device addresses and
+heap start follow the word size.
+"""
+import argparse
+
+from libcompiler import compile_file, save_file, CompileError, CompileCache
+from libcpu import WORD_SIZES
+from librom import save_program
 
 
 LIB_DIR = "programs/"
-HEAP_START = 64
 #  STACK_START = 16
-DEVICES = {
-    "%RNG": 40,
-    "%NUMB": 2
-}
-FILENAME = "bubble_sort"
-
-code = load_file(f"programs/{FILENAME}.s")
-code = include_includes(code, LIB_DIR)
-
-for line in code:
-    print(line)
-print("==================================")
-
-code = remove_unneeded_stuff(code)
-code = translate_to_asm(code)
-code, labels = parse_labels(code)
-code = replace_labels(code, labels)
-code = replace_addresses(code, DEVICES, HEAP_START)
-
-for i in range(len(code)):
-    print(i, code[i])
+parser = argparse.ArgumentParser(description="DRC v.2 compiler.")
+parser.add_argument("name", nargs="?", default="bubble_sort",
+                    help="program in programs/, without .s")
+parser.add_argument("-O", dest="optimize", action="store_true",
+                    help="run the peephole optimizer")
+parser.add_argument("-b", dest="binary", action="store_true",
+                    help="save a binary .drb ROM")
+parser.add_argument("-w", "--word-size", type=int, choices=WORD_SIZES,
+                    default=8, help="bits per word, default: 8")
+ARGS = parser.parse_args()
+FILENAME = ARGS.name
+ROM_SIZE = 2**ARGS.word_size
+CACHE = CompileCache()
+
+try:
+    program = compile_file(f"programs/{FILENAME}.s", LIB_DIR, cache=CACHE,
+                           optimize=ARGS.optimize, word_size=ARGS.word_size)
+except CompileError as err:
+    print(err)
+    quit(1)
+
+for i in range(len(program.lines)):
+    location = program.locations[i]
+    print(i, program.lines[i], f"  // {location.file}:{location.line}")
 print("==================================")
+if CACHE.hits:
+    print(f"Unchanged since the last compile, loaded from {CACHE.directory}/")
+for library, dropped in program.dropped.items():
+    print(f"{library}: {dropped} unreachable instructions dropped")
+if ARGS.optimize:
+    print(f"Optimizer: {sum(program.optimizations.values())} changes, "
+          + ", ".join(f"{name} {count}" for name, count
+                      in program.optimizations.items() if count))
+if len(program.lines) > ROM_SIZE:
+    print(f"Warning: {len(program.lines)} instructions don't fit "
+          f"in a ROM of {ROM_SIZE}")
 
 
 if input("Save assembly? Y/n\n") != "n":
-    save_file(f"programs/{FILENAME}.a", code)
+    if ARGS.binary:
+        save_program(f"programs/{FILENAME}.drb", program, ARGS.word_size)
+    else:
+        save_file(f"programs/{FILENAME}.a", program.lines)
     print("Saving assembly...")
 
 quit(0)
@@ -0,0 +1,401 @@
+""" Command line front end for the DRC v.2 emulator.
+
+    python -m drc run programs/mod_calc.a --input 17,5
+    python -m drc run programs/rand_array.a --seed 1 --max-cycles 100000
+    python -m drc run programs/bubble_sort.a --counters
+    python -m drc run programs/calc_gcd.a --break ".gcd if R2 == 0"
+    python -m drc batch jobs.jsonl -j 4
+    python -m drc run programs/bubble_sort.a --trace-file old.trace
+    python -m drc trace diff old.trace new.trace
+    python -m drc profile programs/calc_gcd.a --json > gcd.json
+    python -m drc convert programs/calc_gcd.a calc_gcd.drb
+    python -m drc serve --port 7000 --root programs/
+
+run prints the console output, oldest first, on stdout and the run
+statistics on stderr. Its exit status is 0 when the program halted,
+EXIT_CODES[EXIT_CYCLES] when it hit --max-cycles, EXIT_CODES[EXIT_WAIT]
+when it stalled waiting for console input and EXIT_CODES[EXIT_BREAK] when
+it stopped at a --break point. trace diff exits with 0 when both traces
+are identical, 1 when they differ and 2 when one can't be read, batch
+with 1 when some job failed.
+"""
+import argparse
+import json
+import sys
+from time import perf_counter
+
+from libcpu import (DRCv2System, load_program, disassemble, CONSOLE_ADDR,
+                    EXIT_HALT, EXIT_CYCLES, EXIT_WAIT, EXIT_BREAK,
+                    WORD_SIZES)
+
+
+EXIT_CODES = {EXIT_HALT: 0, EXIT_CYCLES: 3, EXIT_WAIT: 4, EXIT_BREAK: 5}
+
+ENGINES = ["interpreter", "blocks"]
+
+
+def parse_values(text):
+    """ Console input from the command line, e.g. "17,5". """
+    try:
+        return [int(val) for val in text.replace(",", " ").split()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"expected comma separated integers, got {text!r}") from None
+
+
+class TracePrinter():
+    """ Step hook printing every executed instruction and the registers
+    it left behind. """
+    def __init__(self, system, out=sys.stdout):
+        self.system = system
+        self.out = out
+
+    def before(self, pc, instruction):
+        pass
+
+    def after(self, pc, instruction):
+        system = self.system
+        status = system.status_reg
+        if status["wait_bit"]:
+            return
+        regs = " ".join(f"{reg:3}" for reg in system.registers)
+        flags = ("c" if status["carry_flag"] else "-") \
+            + ("z" if status["zero_flag"] else "-")
+        self.out.write(f"{system.cycles:8} {pc:3}  "
+                       f"{disassemble(instruction):<22} {flags}  {regs}\n")
+
+
+def setup_system(args):
+    """ System with the ROM and console input from the run arguments,
+    None after printing an error. """
+    system = DRCv2System(args.word_size, seed=args.seed)
+    try:
+        system.program = load_program(system.word_size, args.rom)
+    except (OSError, ValueError) as err:
+        print(f"drc: {err}", file=sys.stderr)
+        return None
+    system.set_engine(args.engine)
+
+    console = system.devices[CONSOLE_ADDR]
+    if args.input:
+        console.feed(args.input)
+    if args.input_file:
+        try:
+            console.feed_file(args.input_file)
+        except OSError as err:
+            print(f"drc: {err}", file=sys.stderr)
+            return None
+        except ValueError as err:
+            # int() names the bad value but not the file.
+            print(f"drc: {args.input_file}: {err}", file=sys.stderr)
+            return None
+    return system
+
+
+def cmd_run(args):
+    """ drc run: execute one ROM at full speed. """
+    system = setup_system(args)
+    if system is None:
+        return 1
+    console = system.devices[CONSOLE_ADDR]
+    if args.trace:
+        system.add_hook(TracePrinter(system))
+    if args.trace_file:
+        system.start_trace(args.trace_file)
+    if args.counters:
+        system.enable_counters()
+    labels = {}
+    if args.breakpoints:
+        # Imported here, resolving labels pulls in the compiler.
+        from libdebug import parse_point
+        from libprofile import rom_labels
+        from libcompiler import DEVICES, CompileError
+        try:
+            labels = rom_labels(args.rom, system.program,
+                                word_size=args.word_size)
+        except ValueError as err:
+            # Stale source, only plain addresses can be trusted.
+            print(f"drc: warning: {err}, labels unavailable",
+                  file=sys.stderr)
+        except (OSError, CompileError) as err:
+            print(f"drc: {err}", file=sys.stderr)
+            return 1
+        try:
+            points = system.get_breakpoints()
+            for spec in args.breakpoints:
+                points.add(*parse_point(spec, labels, DEVICES,
+                                        args.word_size))
+        except ValueError as err:
+            print(f"drc: {err}", file=sys.stderr)
+            return 1
+
+    start = perf_counter()
+    reason, cycles = system.run(max_cycles=args.max_cycles)
+    while reason == EXIT_WAIT and args.stdin:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        try:
+            console.feed(parse_values(line))
+        except argparse.ArgumentTypeError as err:
+            print(f"drc: {err}", file=sys.stderr)
+            continue
+        more = None if args.max_cycles is None else args.max_cycles - cycles
+        reason, done = system.run(max_cycles=more)
+        cycles += done
+    elapsed = perf_counter() - start - system.waited()
+    system.stop_trace()
+
+    for val in reversed(console.buffer):
+        print(val)
+    if not args.quiet:
+        rate = cycles / elapsed if elapsed else 0
+        print(f"{reason} at pc {system.program_counter}: {cycles} cycles "
+              f"in {elapsed:.4f} s, {rate:.0f} instructions/s",
+              file=sys.stderr)
+        if reason == EXIT_WAIT:
+            print(f"waiting for device {system.wait_device()}",
+                  file=sys.stderr)
+        if system.waited():
+            print(f"waited {system.waited():.4f} s for input",
+                  file=sys.stderr)
+    if reason == EXIT_BREAK:
+        from libdebug import describe
+        print(f"stopped at {describe(system.breakpoints.hit, labels)}",
+              file=sys.stderr)
+    if args.counters:
+        # Imported here, only --counters needs the formatting.
+        from libcounters import format_counters
+        print(format_counters(system.counters.as_dict()), file=sys.stderr)
+    return EXIT_CODES[reason]
+
+
+def cmd_profile(args):
+    """ drc profile: run one ROM and report where its cycles went. """
+    # Imported here, libprofile pulls in the compiler.
+    from libprofile import profile_report, format_report, guess_source
+    from libcompiler import CompileError
+    system = setup_system(args)
+    if system is None:
+        return 1
+    profiler = system.enable_profiler()
+    reason, _ = system.run(max_cycles=args.max_cycles)
+
+    # .drb ROMs carry their own symbol table.
+    source = args.source or guess_source(args.rom)
+    try:
+        report = profile_report(profiler, source, args.libdir,
+                                args.optimized, rom=args.rom,
+                                word_size=args.word_size)
+    except (OSError, CompileError) as err:
+        print(f"drc: {err}", file=sys.stderr)
+        return 1
+    report["rom"] = args.rom
+    report["exit"] = reason
+
+    if args.json:
+        print(json.dumps(report, indent=1))
+    else:
+        print(f"{args.rom}: {reason}, " + format_report(report, args.top))
+    return EXIT_CODES[reason]
+
+
+def cmd_trace_show(args):
+    """ drc trace show: print records of a trace file. """
+    from libtrace import TraceReader, format_record
+    try:
+        reader = TraceReader(args.trace)
+    except (OSError, ValueError) as err:
+        print(f"drc: {err}", file=sys.stderr)
+        return 1
+    with reader:
+        stop = len(reader) if args.count is None \
+            else min(args.start + args.count, len(reader))
+        for idx in range(args.start, stop):
+            print(format_record(reader[idx]))
+    return 0
+
+
+def cmd_trace_diff(args):
+    """ drc trace diff: report the first record where two traces differ. """
+    from libtrace import TraceReader, diff_traces, format_record
+    try:
+        old = TraceReader(args.old)
+    except (OSError, ValueError) as err:
+        print(f"drc: {err}", file=sys.stderr)
+        return 2
+    try:
+        new = TraceReader(args.new)
+    except (OSError, ValueError) as err:
+        old.close()
+        print(f"drc: {err}", file=sys.stderr)
+        return 2
+    with old, new:
+        idx = diff_traces(old, new)
+        if idx is None:
+            print(f"identical, {len(old)} records")
+            return 0
+        print(f"traces diverge at record {idx}")
+        for reader, name in ((old, args.old), (new, args.new)):
+            first = max(idx - args.context, 0)
+            print(f"--- {name}, {len(reader)} records")
+            for i in range(first, min(idx + 1, len(reader))):
+                print(("> " if i == idx else "  ") + format_record(reader[i]))
+            if idx >= len(reader):
+                print("> end of trace")
+    return 1
+
+
+def cmd_convert(args):
+    """ drc convert: translate a ROM between .a and .drb. """
+    from librom import convert
+    try:
+        convert(args.src, args.dest, args.word_size)
+    except (OSError, ValueError) as err:
+        print(f"drc: {err}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def cmd_serve(args):
+    """ drc serve: host interactive sessions, see libserver. """
+    # Imported here, only the server needs asyncio.
+    import asyncio
+    from libserver import serve
+    where = args.unix or f"{args.host}:{args.port}"
+    print(f"drc: serving {args.root} on {where}", file=sys.stderr)
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, args.root,
+                          args.slice, args.engine))
+    except KeyboardInterrupt:
+        pass
+    except OSError as err:
+        print(f"drc: {err}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def cmd_batch(args):
+    """ drc batch: run a JSON Lines job file on a process pool. """
+    # Imported here, only batch runs need the process pool.
+    from libbatch import run_batch, read_jobs
+    try:
+        jobs = read_jobs(args.jobs)
+    except (OSError, ValueError) as err:
+        print(f"drc: {err}", file=sys.stderr)
+        return 1
+    _, failed = run_batch(jobs, workers=args.workers, engine=args.engine)
+    if failed:
+        print(f"drc: {failed} of {len(jobs)} jobs failed", file=sys.stderr)
+        return 1
+    return 0
+
+
+def add_run_arguments(parser):
+    """ Arguments shared by the commands that run a ROM. """
+    parser.add_argument("rom", help=".a or .drb file to load")
+    parser.add_argument("--input", type=parse_values, default=[],
+                        help="console input values, e.g. 17,5")
+    parser.add_argument("--input-file", help="file with console input values")
+    parser.add_argument("--max-cycles", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=None, help="RNG seed")
+    parser.add_argument("--engine", choices=ENGINES, default="interpreter")
+    parser.add_argument("--word-size", type=int, choices=WORD_SIZES,
+                        default=8, help="bits per word, default: 8")
+
+
+def build_parser():
+    """ Argument parser with one subparser per command. """
+    parser = argparse.ArgumentParser(prog="drc",
+                                     description="DRC v.2 emulator.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run a ROM headless")
+    add_run_arguments(run)
+    verbosity = run.add_mutually_exclusive_group()
+    verbosity.add_argument("--quiet", action="store_true",
+                           help="don't print run statistics")
+    verbosity.add_argument("--trace", action="store_true",
+                           help="print every executed instruction")
+    run.add_argument("--break", dest="breakpoints", action="append",
+                     default=[], metavar="POINT",
+                     help="stop at [read|write] <address or label> "
+                          "[if <condition>], e.g. \".loop if R1 == 0\"")
+    run.add_argument("--stdin", action="store_true",
+                     help="read console input from stdin whenever the "
+                          "program waits for it")
+    run.add_argument("--counters", action="store_true",
+                     help="print the performance counters")
+    run.add_argument("--trace-file",
+                     help="write a binary execution trace, see drc trace")
+    run.set_defaults(func=cmd_run)
+
+    profile = commands.add_parser("profile", help="run a ROM and report "
+                                                  "its hot spots")
+    add_run_arguments(profile)
+    profile.add_argument("--source", help=".s file the ROM was compiled "
+                                          "from, default: next to the ROM")
+    profile.add_argument("--libdir", help="directory of @INCLUDE files, "
+                                          "default: next to the source")
+    profile.add_argument("--optimized", action="store_true",
+                         help="the ROM was compiled with the optimizer")
+    profile.add_argument("--top", type=int, default=20,
+                         help="hottest addresses listed")
+    profile.add_argument("--json", action="store_true",
+                         help="print the full report as JSON")
+    profile.set_defaults(func=cmd_profile)
+
+    trace = commands.add_parser("trace", help="inspect binary traces")
+    trace_commands = trace.add_subparsers(dest="trace_command", required=True)
+    show = trace_commands.add_parser("show", help="print trace records")
+    show.add_argument("trace")
+    show.add_argument("--start", type=int, default=0)
+    show.add_argument("--count", type=int, default=None)
+    show.set_defaults(func=cmd_trace_show)
+    diff = trace_commands.add_parser("diff", help="find where two traces "
+                                                  "diverge")
+    diff.add_argument("old")
+    diff.add_argument("new")
+    diff.add_argument("--context", type=int, default=5,
+                      help="records shown before the divergence")
+    diff.set_defaults(func=cmd_trace_diff)
+
+    convert = commands.add_parser("convert", help="convert a ROM between "
+                                                  "the .a and .drb formats")
+    convert.add_argument("src")
+    convert.add_argument("dest", help="output, .drb for a binary ROM, "
+                                      "anything else for text")
+    convert.add_argument("--word-size", type=int, choices=WORD_SIZES,
+                         default=8, help="bits per word of a .a source")
+    convert.set_defaults(func=cmd_convert)
+
+    serve = commands.add_parser("serve", help="host interactive sessions "
+                                              "over a socket")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=7000)
+    serve.add_argument("--unix", metavar="PATH",
+                       help="listen on a Unix socket instead of TCP")
+    serve.add_argument("--root", default=".",
+                       help="directory sessions may load ROMs from")
+    serve.add_argument("--slice", type=int, default=10000,
+                       help="cycles a session runs before the others get "
+                            "a turn")
+    serve.add_argument("--engine", choices=ENGINES, default="interpreter")
+    serve.set_defaults(func=cmd_serve)
+
+    batch = commands.add_parser("batch", help="run many jobs in parallel")
+    batch.add_argument("jobs", help="JSON Lines file with one job per line")
+    batch.add_argument("-j", "--workers", type=int, default=None)
+    batch.add_argument("--engine", choices=ENGINES, default="interpreter")
+    batch.set_defaults(func=cmd_batch)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,49 +1,15 @@
-""" libcpu test """
-from time import sleep
-from libcpu import DRCv2System
+""" libcpu test, traces a ROM in the terminal.
 
-sys0 = DRCv2System()
+Thin wrapper around drc.py kept for old habits:
+    python emulator.py [rom.a] [drc run options]
+is the same as
+    python -m drc run rom.a --trace [drc run options]
+"""
+import sys
 
-sys0.load_rom("programs/mod_calc.a")
-#  sys0.load_rom("programs/test.a")
+from drc import main
 
-with open("programs/mod_calc.a", "r") as f:
-    PROGRAM = []
-    idx = 0
-    for line in f:
-        PROGRAM.append(f"{idx} " + line.strip())
-        idx += 1
 
-from os import system
-
-while True:
-
-    system("clear")
-
-    sys0.dump_all()
-
-    sys0.get_next_state()
-    #  input()
-    sleep(0.1)
-
-    if sys0.status_reg["halt_bit"] == True:
-        quit()
-
-
-# Program printing
-for line in PROGRAM:
-    if int(line.split()[0]) == sys0.program_counter:
-        print(line + "    <--")
-    else:
-        print(line)
-
-# show console
-print(sys0.devices[2].buffer[0])
-
-# print registers
-for i in range(len(sys0.registers)):
-    print(f"register {i}: {sys0.registers[i]}")
-
-# pritn core memory
-for i in range(64, 96):
-    print(sys0.devices[i].val)
+if __name__ == "__main__":
+    args = sys.argv[1:] or ["programs/mod_calc.a"]
+    sys.exit(main(["run", args[0], "--trace"] + args[1:]))
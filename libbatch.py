@@ -0,0 +1,137 @@
+""" Headless batch runner for many DRC v.2 jobs.
+
+A job is (rom path, console input sequence, RNG seed, cycle limit, word
+size). Jobs are spread over a process pool, every worker process decodes
+each ROM only once and reuses it for all of its jobs. Results are written
+as JSON Lines in completion order. A job that fails, e.g. on a missing
+ROM, gets a {"job": ..., "rom": ..., "error": ...} line instead and the
+others go on.
+
+Usage: python libbatch.py jobs.jsonl [-j WORKERS] [--engine blocks]
+where every line of jobs.jsonl looks like
+{"rom": "programs/mod_calc.a", "input": [17, 5], "seed": 1, "max_cycles": 10000}
+"word_size" is optional and defaults to 8, "max_cycles" to MAX_CYCLES; a
+job that runs out of cycles reports "exit": "max_cycles".
+"""
+import argparse
+import json
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from libcpu import DRCv2System, Console, load_program, CONSOLE_ADDR
+
+
+# Cycles of a job without a limit of its own, so a program that never
+# halts can't hold up the batch.
+MAX_CYCLES = 10**7
+
+# Decoded ROMs of this worker process, by path and word size.
+ROM_CACHE = {}
+
+
+def get_program(path, bits=8):
+    """ Decode path once per process. """
+    if (path, bits) not in ROM_CACHE:
+        ROM_CACHE[path, bits] = load_program(bits, path)
+    return ROM_CACHE[path, bits]
+
+
+def run_job(job, engine="interpreter"):
+    """ Run a single job to completion, returns its result dict. """
+    idx, (rom, inputs, seed, max_cycles, word_size) = job
+    system = DRCv2System(word_size, seed=seed)
+    system.set_engine(engine)
+    system.program = get_program(rom, system.word_size)
+    # Keep all of the output, the job result reports it.
+    console = Console(bits=system.word_size, history=None)
+    console.feed(inputs or ())
+    system.devices[CONSOLE_ADDR] = console
+
+    reason, _ = system.run(max_cycles=max_cycles)
+
+    return {
+        "job": idx,
+        "rom": rom,
+        "exit": reason,
+        "cycles": system.cycles,
+        "pc": system.program_counter,
+        "registers": system.registers,
+        "status": system.status_reg,
+        "ram": list(system.ram),
+        "console": list(reversed(console.buffer)),
+    }
+
+
+def normalise_job(job):
+    """ Accept jobs as tuples or as dicts read from JSON. """
+    if isinstance(job, dict):
+        rom, inputs, seed = job["rom"], job.get("input", []), job.get("seed")
+        max_cycles, word_size = job.get("max_cycles"), job.get("word_size", 8)
+    else:
+        rom, inputs, seed, max_cycles, *word_size = job
+        word_size = (word_size or [8])[0]
+    if max_cycles is None:
+        max_cycles = MAX_CYCLES
+    return rom, inputs, seed, max_cycles, word_size
+
+
+def job_error(idx, job, err):
+    """ Result line of a job that failed. """
+    rom = job.get("rom") if isinstance(job, dict) \
+        else job[0] if isinstance(job, (list, tuple)) and job else None
+    return {"job": idx, "rom": rom, "error": f"{type(err).__name__}: {err}"}
+
+
+def run_batch(jobs, out=sys.stdout, workers=None, engine="interpreter"):
+    """ Run all jobs on a process pool, streaming one JSON line per result.
+    Returns (jobs run, jobs failed). """
+    done = 0
+    failed = 0
+
+    def emit(result):
+        out.write(json.dumps(result) + "\n")
+        out.flush()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for idx, job in enumerate(jobs):
+            try:
+                normalised = normalise_job(job)
+            except (KeyError, TypeError, ValueError) as err:
+                emit(job_error(idx, job, err))
+                failed += 1
+                continue
+            futures[pool.submit(run_job, (idx, normalised), engine)] = \
+                (idx, job)
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as err:
+                # Keep the results of the other jobs.
+                result = job_error(*futures[future], err)
+                failed += 1
+            emit(result)
+            done += 1
+    return done, failed
+
+
+def read_jobs(filename):
+    """ Load jobs from a JSON Lines file. """
+    with open(filename, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run DRC v.2 jobs in parallel.")
+    parser.add_argument("jobs", help="JSON Lines file with one job per line")
+    parser.add_argument("-j", "--workers", type=int, default=None)
+    parser.add_argument("--engine", choices=["interpreter", "blocks"],
+                        default="interpreter")
+    args = parser.parse_args(argv)
+    _, failed = run_batch(read_jobs(args.jobs), workers=args.workers,
+                          engine=args.engine)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,332 @@
+""" Basic-block translator for the DRC v.2 emulator.
+
+Splits the decoded ROM into basic blocks and turns each of them into a
+Python function, with R0 and immediates folded into the generated code
+and ALU operations turned into lookups in the shared ALU tables.
+Registers and flags live in locals while a block runs and are written back
+at every block exit, so a block leaves exactly the same state behind as
+the interpreter would after executing the same instructions.
+"""
+from libcpu import (OP_ADD, OP_SUB, OP_RSH, OP_INC, OP_DEC, OP_NOR, OP_AND,
+                    OP_LOD, OP_STR, OP_IMM, OP_MSC, OP_BRNCH,
+                    COND_ALWAYS, COND_Z, COND_NZ, COND_C, COND_NC, COND_NC_NZ,
+                    COND_C_Z, COND_C_NZ, COND_HALT,
+                    EXIT_HALT, EXIT_CYCLES, EXIT_PC, EXIT_WAIT)
+
+
+# Longest straight-line run compiled into a single block.
+MAX_BLOCK_LEN = 64
+
+# Python expressions for branch conditions, in terms of the flag locals.
+COND_EXPRS = {
+    COND_Z: "zf",
+    COND_NZ: "not zf",
+    COND_C: "cf",
+    COND_NC: "not cf",
+    COND_NC_NZ: "not cf and not zf",
+    COND_C_Z: "cf and zf",
+    COND_C_NZ: "cf and not zf",
+}
+
+
+def find_leaders(program):
+    """ Addresses that start a basic block: the entry point, constant
+    branch targets and the instructions following a branch or halt. """
+    leaders = {0}
+    for pc, (opcode, _, _, src_b, imm, cnd) in enumerate(program):
+        if opcode == OP_BRNCH:
+            if src_b == 0:
+                leaders.add(imm % len(program))
+            leaders.add((pc + 1) % len(program))
+        elif opcode == OP_MSC and cnd == COND_HALT:
+            leaders.add((pc + 1) % len(program))
+    return leaders
+
+
+class BlockTranslator():
+    """ Execution engine running a DRCv2System a basic block at a time. """
+    def __init__(self, system):
+        self.system = system
+        self.program = None
+        self.leaders = set()
+        self.blocks = {}
+
+    def invalidate(self):
+        """ Drop all compiled blocks, called whenever the ROM is reloaded. """
+        self.program = self.system.program
+        self.leaders = find_leaders(self.program)
+        self.blocks = {}
+
+    def run(self, max_cycles=None, until_halt=True, until_pc=None):
+        """ Same contract as DRCv2System.run(). """
+        system = self.system
+        if system.program is not self.program:
+            self.invalidate()
+
+        blocks = self.blocks
+        status = system.status_reg
+        regs = system.registers
+        devices = system.devices
+        memory = system.memory
+        start = system.cycles
+        limit = None if max_cycles is None else start + max_cycles
+
+        if status["halt_bit"] and until_halt:
+            return EXIT_HALT, 0
+
+        while True:
+            if system.cycles == limit:
+                reason = EXIT_CYCLES
+                break
+
+            pc = system.program_counter
+            try:
+                func, length, last = blocks[pc]
+            except KeyError:
+                func, length, last = blocks[pc] = self.translate(pc)
+
+            if func is None or status["halt_bit"] \
+                    or (limit is not None and system.cycles + length > limit) \
+                    or (until_pc is not None and pc < until_pc <= last):
+                system.get_next_state()
+            else:
+                system.program_counter, done = \
+                    func(system, regs, status, devices, memory,
+                         system.dirty_cells)
+                if done == 0:
+                    # The block stopped in front of a console read.
+                    system.get_next_state()
+                system.cycles += done
+
+            if status["wait_bit"]:
+                reason = EXIT_WAIT
+                break
+            if status["halt_bit"] and until_halt:
+                reason = EXIT_HALT
+                break
+            if system.program_counter == until_pc:
+                reason = EXIT_PC
+                break
+
+        return reason, system.cycles - start
+
+    def translate(self, start):
+        """ Compile the block starting at start.
+
+        Returns (function, length, last_pc). function is None when the
+        instruction at start has to go through the interpreter.
+        """
+        source = BlockSource(self.program, self.system.devices, start,
+                             self.system.word_size)
+        length = source.generate(self.leaders)
+        if length == 0:
+            return None, 1, start
+
+        tables = self.system.alu.tables
+        namespace = {"ADD": tables.add, "SUB": tables.sub, "NOR": tables.nor,
+                     "AND": tables.and_, "RSH": tables.rsh}
+        code = compile("\n".join(source.lines), f"<block {start}>", "exec")
+        exec(code, namespace)
+        return namespace["block"], length, start + length - 1
+
+
+class BlockSource():
+    """ Python source generator for a single basic block. """
+    def __init__(self, program, devices, start, word_size=8):
+        self.program = program
+        self.devices = devices
+        self.shift = word_size
+        self.start = start
+        self.body = []
+        self.lines = []
+        self.read_regs = set()
+        self.dirty_regs = set()
+        self.dirty_flags = set()
+        self.uses_flags = False
+        self.consts = {}
+        self.last_str = None
+        self.tmp = 0
+
+    def reg(self, idx):
+        """ Expression for reading register idx. """
+        if idx == 0:
+            return "0"
+        if idx in self.consts:
+            return str(self.consts[idx])
+        self.read_regs.add(idx)
+        return f"r{idx}"
+
+    def operand(self, src_b, imm):
+        """ Expression for the imm | src_b operand. """
+        if src_b == 0 or (src_b in self.consts):
+            return str(imm | (self.consts.get(src_b, 0)))
+        if imm == 0:
+            return self.reg(src_b)
+        return f"({imm} | {self.reg(src_b)})"
+
+    def index(self, val_a, val_b):
+        """ Expression for the ALU table index of (val_a, val_b). """
+        if val_a.isdigit() and val_b.isdigit():
+            return str(int(val_a) << self.shift | int(val_b))
+        if val_a.isdigit():
+            return f"{int(val_a) << self.shift} | {val_b}"
+        if val_b == "0":
+            return f"{val_a} << {self.shift}"
+        return f"{val_a} << {self.shift} | {val_b}"
+
+    def dest(self, idx):
+        """ Target name for writing register idx. """
+        self.consts.pop(idx, None)
+        if idx == 0:
+            return "_"
+        self.dirty_regs.add(idx)
+        return f"r{idx}"
+
+    def exit(self, indent, next_pc, executed):
+        """ Lines writing back the state and leaving the block. """
+        pad = " " * indent
+        out = []
+        for idx in sorted(self.dirty_regs):
+            out.append(f"{pad}r[{idx}] = r{idx}")
+        if "c" in self.dirty_flags:
+            out.append(f"{pad}st['carry_flag'] = cf")
+        if "z" in self.dirty_flags:
+            out.append(f"{pad}st['zero_flag'] = zf")
+        out.append(f"{pad}s.last_written = {self.last_str}")
+        out.append(f"{pad}return {next_pc}, {executed}")
+        return out
+
+    def generate(self, leaders):
+        """ Fill in self.lines, returns the number of instructions compiled. """
+        program = self.program
+        rom_size = len(program)
+        body = self.body
+        pc = self.start
+        count = 0
+        finished = False
+
+        while not finished:
+            opcode, dest, src_a, src_b, imm, cnd = program[pc]
+            next_pc = (pc + 1) % rom_size
+            last_str = None
+
+            if opcode == OP_ADD or opcode == OP_SUB:
+                table = "ADD" if opcode == OP_ADD else "SUB"
+                idx = self.index(self.reg(src_a), self.operand(src_b, imm))
+                body.append(f"    {self.dest(dest)}, cf, zf = {table}[{idx}]")
+                self.dirty_flags.update("cz")
+
+            elif opcode == OP_RSH:
+                val_a = self.reg(src_a)
+                body.append(f"    {self.dest(dest)}, cf = RSH[{val_a}]")
+                self.dirty_flags.add("c")
+
+            elif opcode == OP_INC or opcode == OP_DEC:
+                if dest != 0:
+                    table = "ADD" if opcode == OP_INC else "SUB"
+                    idx = self.index(self.reg(src_a), "1")
+                    body.append(f"    {self.dest(dest)} = {table}[{idx}][0]")
+
+            elif opcode == OP_NOR or opcode == OP_AND:
+                if dest != 0:
+                    val_a = self.reg(src_a)
+                    if opcode == OP_NOR:
+                        table = "NOR"
+                        val_b = self.operand(src_b, imm)
+                    else:
+                        table = "AND"
+                        val_b = self.reg(src_b)
+                    idx = self.index(val_a, val_b)
+                    body.append(f"    {self.dest(dest)} = {table}[{idx}][0]")
+
+            elif opcode == OP_LOD:
+                addr = self.operand(src_b, imm)
+                if addr == "2":
+                    # Console reads may stall, leave them to the interpreter.
+                    break
+                if addr.isdigit():
+                    if self.devices[int(addr)] is None:
+                        value = f"mem[{addr}]"
+                    else:
+                        value = f"dev[{addr}].read()"
+                else:
+                    body.append(f"    addr = {addr}")
+                    body.append("    if addr == 2:")
+                    body.extend(self.exit(8, pc, count))
+                    body.append("    device = dev[addr]")
+                    value = "mem[addr] if device is None else device.read()"
+                body.append(f"    {self.dest(dest)} = {value}")
+
+            elif opcode == OP_STR:
+                addr = self.operand(src_b, imm)
+                value = self.reg(src_a)
+                if addr.isdigit():
+                    if self.devices[int(addr)] is None:
+                        body.append(f"    mem[{addr}] = {value}")
+                        body.append(f"    dirty.add({addr})")
+                    else:
+                        body.append(f"    dev[{addr}].write({value})")
+                else:
+                    self.tmp += 1
+                    body.append(f"    a{self.tmp} = {addr}")
+                    addr = f"a{self.tmp}"
+                    body.append(f"    device = dev[{addr}]")
+                    body.append("    if device is None:")
+                    body.append(f"        mem[{addr}] = {value}")
+                    body.append(f"        dirty.add({addr})")
+                    body.append("    else:")
+                    body.append(f"        device.write({value})")
+                last_str = addr
+
+            elif opcode == OP_IMM:
+                if dest != 0:
+                    body.append(f"    {self.dest(dest)} = {imm}")
+                    self.consts[dest] = imm
+
+            elif opcode == OP_MSC:
+                if cnd == COND_HALT:
+                    body.append("    st['halt_bit'] = True")
+                    next_pc = pc
+                    finished = True
+
+            elif opcode == OP_BRNCH:
+                target = self.operand(src_b, imm)
+                if not target.isdigit():
+                    body.append(f"    target = {target}")
+                    target = "target"
+                count += 1
+                self.last_str = None
+                if cnd == COND_ALWAYS:
+                    body.extend(self.exit(4, target, count))
+                elif cnd in COND_EXPRS:
+                    if not self.dirty_flags >= {"c", "z"}:
+                        self.uses_flags = True
+                    body.append(f"    if {COND_EXPRS[cnd]}:")
+                    body.extend(self.exit(8, target, count))
+                    body.extend(self.exit(4, next_pc, count))
+                else:
+                    body.extend(self.exit(4, next_pc, count))
+                break
+
+            count += 1
+            self.last_str = last_str
+            if finished or count >= MAX_BLOCK_LEN \
+                    or next_pc in leaders or next_pc == 0:
+                body.extend(self.exit(4, next_pc, count))
+                break
+            pc = next_pc
+
+        if count == 0:
+            return 0
+        if not body or not body[-1].lstrip().startswith("return"):
+            # Stopped in front of a console read.
+            body.extend(self.exit(4, pc, count))
+
+        self.lines.append("def block(s, r, st, dev, mem, dirty):")
+        for idx in sorted(self.read_regs):
+            self.lines.append(f"    r{idx} = r[{idx}]")
+        if self.uses_flags:
+            self.lines.append("    cf = st['carry_flag']")
+            self.lines.append("    zf = st['zero_flag']")
+        self.lines.extend(body)
+        return count
@@ -1,326 +1,451 @@
-""" Code library for DRC v.2 compiler. """
+""" Code library for DRC v.2 compiler.
 
+Every source line is tokenized once into a Statement that remembers its
+file and line number. expand() turns statements into AsmInstruction and
+Label objects through the MACROS table, link() gives labels their
+addresses, and resolve() turns the typed operands into the numbers of the
+.a format. Only emit() goes back to text.
 
-def load_file(filename: str) -> str:
-    """ Load source code from file. """
-    code_out = []
+    program = compile_file("programs/calc_gcd.s", "programs/")
+    save_file("programs/calc_gcd.a", program.lines)
+
+A CompileCache passed to compile_file() keeps compiled programs and the
+expanded code of libraries on disk, keyed by content hashes, so unchanged
+programs and shared libraries aren't parsed again.
+"""
+import hashlib
+import os
+import pickle
+from collections import namedtuple
+
+from libcpu import CONSOLE_ADDR, RNG_ADDR, heap_start as heap_start_of
+
+
+Location = namedtuple("Location", "file line")
+
+
+class CompileError(Exception):
+    """ Error in a source program, prefixed with its location. """
+    def __init__(self, message, location=None):
+        if location is not None:
+            message = f"{location.file}:{location.line}: {message}"
+        super().__init__(message)
+        self.location = location
+
+
+# Operand kinds, told apart by the first character of the token.
+REG, IMM, LABEL, DEVICE, HEAP = "reg", "imm", "label", "device", "heap"
+OPERAND_KINDS = {"R": REG, ".": LABEL, "%": DEVICE, "#": HEAP}
+
+
+class Operand():
+    """ One operand token of a source instruction. """
+    __slots__ = ("kind", "text")
+
+    def __init__(self, text):
+        self.kind = OPERAND_KINDS.get(text[0], IMM)
+        self.text = text
+
+    def __repr__(self):
+        return f"Operand({self.text!r})"
+
+    def resolve(self, labels, devices, heap_start, location=None):
+        """ Text of the operand in the .a format. """
+        try:
+            if self.kind == IMM:
+                return self.text
+            if self.kind == REG:
+                return str(int(self.text[1:]))
+            if self.kind == LABEL:
+                return str(labels[self.text])
+            if self.kind == DEVICE:
+                return str(devices[self.text])
+            return str(int(self.text[1:]) + heap_start)
+        except KeyError:
+            raise CompileError(f"Unknown {self.kind} {self.text}",
+                               location) from None
+        except ValueError:
+            raise CompileError(f"Bad {self.kind} operand {self.text}",
+                               location) from None
+
+
+class Statement():
+    """ A tokenized source line: label or mnemonic with its operands. """
+    __slots__ = ("mnemonic", "operands", "location")
+
+    def __init__(self, mnemonic, operands, location):
+        self.mnemonic = mnemonic
+        self.operands = operands
+        self.location = location
+
+    def is_label(self):
+        return self.mnemonic[0] == "."
+
+
+class Label():
+    """ Marks the address of the next instruction. generated is set for
+    labels the macro expander made up. """
+    __slots__ = ("name", "location", "generated")
+
+    def __init__(self, name, location, generated=False):
+        self.name = name
+        self.location = location
+        self.generated = generated
+
+
+class AsmInstruction():
+    """ One machine instruction: opcode and five fields, each either a
+    fixed text or an Operand still to be resolved. """
+    __slots__ = ("opcode", "fields", "location")
+
+    def __init__(self, opcode, fields, location):
+        self.opcode = opcode
+        self.fields = fields
+        self.location = location
+
+    def __repr__(self):
+        return f"AsmInstruction({self.opcode!r}, {self.fields!r})"
+
+
+# Return label of a CAL, in MACROS templates.
+RETURN = "RETURN"
+
+# Macro templates: the machine instructions every mnemonic expands to.
+# Integers are indices into the source operands (1 is the first one),
+# RETURN as a field refers to, and as an entry places, a fresh label.
+MACROS = {
+    "ADD": (("ADD", 1, 2, 3, "0", "0"),),
+    "ADDI": (("ADD", 1, 2, "0", 3, "0"),),
+    "SUB": (("SUB", 1, 2, 3, "0", "0"),),
+    "SUBI": (("SUB", 1, 2, "0", 3, "0"),),
+    "NOR": (("NOR", 1, 2, 3, "0", "0"),),
+    "NORI": (("NOR", 1, 2, "0", 3, "0"),),
+    "AND": (("AND", 1, 2, 3, "0", "0"),),
+    "ANDI": (("AND", 1, 2, "0", 3, "0"),),
+    "RSH": (("RSH", 1, 2, "0", "0", "0"),),
+    "INC": (("ADD", 1, 2, "0", "1", "0"),),
+    "DEC": (("SUB", 1, 2, "0", "1", "0"),),
+    "PLOD": (("LOD", 1, "0", 2, "0", "0"),),
+    "LOD": (("LOD", 1, "0", "0", 2, "0"),),
+    "IMM": (("IMM", 1, "0", "0", 2, "0"),),
+    # note: in source code STR imm src
+    "STR": (("STR", "0", 2, "0", 1, "0"),),
+    "PSTR": (("STR", "0", 2, 1, "0", "0"),),
+    "PSH": (("SUB", "7", "7", "0", "1", "0"),
+            ("STR", "0", 1, "7", "0", "0")),
+    "POP": (("LOD", 1, "0", "7", "0", "0"),
+            ("ADD", "7", "7", "0", "1", "0")),
+    "MOV": (("ADD", 1, 2, "0", "0", "0"),),
+    "OR": (("NOR", 1, 2, 3, "0", "0"),
+           ("NOR", 1, 1, "0", "0", "0")),
+    # BGE A B C: branch to A if B >= C
+    "BGE": (("SUB", "0", 2, 3, "0", "0"),
+            ("BRNCH", "0", "0", "0", 1, "c")),
+    # BRL A B C: branch to A if B < C
+    "BRL": (("SUB", "0", 2, 3, "0", "0"),
+            ("BRNCH", "0", "0", "0", 1, "nc&nz")),
+    # add sets the zero flag.
+    "JMP": (("ADD", "0", "0", "0", "0", "0"),
+            ("BRNCH", "0", "0", "0", 1, "z")),
+    "BRZ": (("ADD", "0", 2, "0", "0", "0"),
+            ("BRNCH", "0", "0", "0", 1, "z")),
+    # push return address, jump; zero flag is unset after sub instr.
+    "CAL": (("IMM", "6", "0", "0", RETURN, "0"),
+            ("SUB", "7", "7", "0", "1", "0"),
+            ("STR", "0", "6", "7", "0", "0"),
+            ("BRNCH", "0", "0", "0", 1, "nz"),
+            RETURN),
+    # pop temp, jump temp
+    "RET": (("LOD", "6", "0", "7", "0", "0"),
+            ("ADD", "7", "7", "0", "1", "0"),
+            ("ADD", "0", "0", "0", "0", "0"),
+            ("BRNCH", "0", "0", "6", "0", "z")),
+    "HLT": (("MSC", "0", "0", "0", "0", "1"),),
+}
+
+# Number of source operands every macro needs.
+MACRO_ARITY = {name: max([field for ins in template if ins != RETURN
+                          for field in ins[1:] if isinstance(field, int)],
+                         default=0)
+               for name, template in MACROS.items()}
+
+
+# Everything besides the sources that decides what compile_file() emits.
+CompileOptions = namedtuple(
+    "CompileOptions", "devices heap_start word_size strip optimize")
+
+# Device names of the sources, at the same address for every word size.
+DEVICES = {
+    "%RNG": RNG_ADDR,
+    "%NUMB": CONSOLE_ADDR
+}
+
+# lines of the .a file, all labels and those written in the sources with
+# their addresses, the Location every instruction came from, the
+# libraries included, how many instructions were stripped from each and
+# how often every optimization was applied.
+CompiledProgram = namedtuple(
+    "CompiledProgram",
+    "lines labels source_labels locations libraries dropped optimizations")
+
+
+def read_source(filename, location=None):
+    """ Lines of a source file. """
     try:
         with open(filename, "r") as f:
-            for line in f:
-                code_out.append(line.strip())
-
+            return f.read().splitlines()
     except FileNotFoundError:
-        print(f"File {filename} not found!")
-        quit(1)
+        raise CompileError(f"File {filename} not found!", location) from None
+
+
+def tokenize(lines, filename):
+    """ Statements of a source file, without comments and blank lines. """
+    for line_no, line in enumerate(lines, 1):
+        words = line.split("//")[0].split(";")[0].split()
+        if words:
+            yield Statement(words[0], [Operand(word) for word in words[1:]],
+                            Location(filename, line_no))
+
+
+def expand(statements):
+    """ Expand statements into Label and AsmInstruction objects. """
+    for statement in statements:
+        if statement.is_label():
+            yield Label(statement.mnemonic, statement.location)
+            continue
+
+        location = statement.location
+        try:
+            template = MACROS[statement.mnemonic]
+        except KeyError:
+            raise CompileError(f"Unknown instruction {statement.mnemonic}",
+                               location) from None
+        operands = statement.operands
+        if len(operands) < MACRO_ARITY[statement.mnemonic]:
+            raise CompileError(f"{statement.mnemonic} expects "
+                               f"{MACRO_ARITY[statement.mnemonic]} operands",
+                               location)
+
+        ret = f".return@{location.file}:{location.line}"
+        for ins in template:
+            if ins == RETURN:
+                yield Label(ret, location, generated=True)
+                continue
+            fields = []
+            for field in ins[1:]:
+                if isinstance(field, int):
+                    fields.append(operands[field - 1])
+                elif field == RETURN:
+                    fields.append(Operand(ret))
+                else:
+                    fields.append(field)
+            yield AsmInstruction(ins[0], fields, location)
+
+
+def parse_file(filename, lines=None):
+    """ Expanded code of one file plus the libraries it includes. lines
+    is the text of the file, if already read. """
+    if lines is None:
+        lines = read_source(filename)
+    code = []
+    includes = []
+    for statement in tokenize(lines, filename):
+        if statement.mnemonic == "@INCLUDE":
+            includes.append((statement.operands[0].text, statement.location))
+        else:
+            code.append(statement)
+    return list(expand(code)), includes
+
+
+def load_program_ir(filename, libdir, cache=None):
+    """ Expanded code of filename followed by the code of every library
+    it includes, directly or through other libraries, each once.
+    Libraries are parsed through cache, if given.
+    Returns (code, library paths). """
+    code, includes = parse_file(filename)
+    seen = []
+    while includes:
+        name, location = includes.pop(0)
+        path = os.path.join(libdir, name)
+        if path in seen:
+            continue
+        if not os.path.exists(path):
+            raise CompileError(f"File {path} not found!", location)
+        seen.append(path)
+        if cache is None:
+            lib_code, lib_includes = parse_file(path)
+        else:
+            lib_code, lib_includes = cache.parse_file(path)
+        code += lib_code
+        includes += lib_includes
+    return code, seen
 
-    return code_out
-
-
-def remove_unneeded_stuff(code_in):
-    code_out = []
-    for line in code_in:
-        if line and line[:2] != "//" and line[:1] != ";" and line != "":
-            line = line.split("//")[0]
-            line = line.split(";")[0]
-            line = line.split()
-
-            code_out.append(line)
-
-    code_in = code_out
-    code_out = []
-
-    for line in code_in:
-        if line:
-            code_out.append(" ".join(line))
-    return code_out
-
-
-def translate_to_asm(code_in: str) -> str:
-    lbl = 343234
-    code_out = []
-    for line in code_in:
-        line = line.split()
-        if line[0][0] == ".":
-            code_out.append(line[0])
-        elif line[0] == "ADD":
-            # add reg reg reg 0 0
-            code_out.append(f"ADD {line[1]} {line[2]} {line[3]} 0 0")
-
-        elif line[0] == "ADDI":
-            #  add reg reg 0 imm 0
-            code_out.append(f"ADD {line[1]} {line[2]} 0 {line[3]} 0")
-
-        elif line[0] == "SUB":
-            # sub reg reg reg 0 0
-            code_out.append(f"SUB {line[1]} {line[2]} {line[3]} 0 0")
-
-        elif line[0] == "SUBI":
-            #  sub reg reg 0 imm 0
-            code_out.append(f"SUB {line[1]} {line[2]} 0 {line[3]} 0")
-
-        elif line[0] == "NOR":
-            # nor reg reg reg 0 0
-            code_out.append(f"NOR {line[1]} {line[2]} {line[3]} 0 0")
-
-        elif line[0] == "NORI":
-            #  nor reg reg 0 imm 0
-            code_out.append(f"NOR {line[1]} {line[2]} 0 {line[3]} 0")
-
-        elif line[0] == "AND":
-            # and reg reg reg 0 0
-            code_out.append(f"AND {line[1]} {line[2]} {line[3]} 0 0")
-
-        elif line[0] == "ANDI":
-            #  and reg reg 0 imm 0
-            code_out.append(f"AND {line[1]} {line[2]} 0 {line[3]} 0")
-
-        elif line[0] == "RSH":
-            # rsh reg reg 0 0 0
-            code_out.append(f"RSH {line[1]} {line[2]} 0 0 0")
-
-        elif line[0] == "INC":
-            # add reg reg 0 1 0
-            code_out.append(f"ADD {line[1]} {line[2]} 0 1 0")
-
-        elif line[0] == "DEC":
-            # sub reg reg 0 1 0
-            code_out.append(f"SUB {line[1]} {line[2]} 0 1 0")
-
-        elif line[0] == "PLOD":
-            # lod reg 0 poi 0 0
-            code_out.append(f"LOD {line[1]} 0 {line[2]} 0 0")
-
-        elif line[0] == "LOD":
-            # lod reg 0 0 imm 0
-            code_out.append(f"LOD {line[1]} 0 0 {line[2]} 0")
-
-        elif line[0] == "IMM":
-            # imm reg 0 0 imm 0
-            code_out.append(f"IMM {line[1]}  0 0 {line[2]} 0")
-
-        elif line[0] == "STR":
-            # note: in source code STR imm src
-            # str 0 reg 0 imm 0
-            code_out.append(f"STR 0 {line[2]} 0 {line[1]} 0")
-
-        elif line[0] == "PSTR":
-            # str 0 reg poi 0 0
-            code_out.append(f"STR 0 {line[2]} {line[1]} 0 0")
-
-        elif line[0] == "PSH":
-            # sub 7 7 0 1 0 (dec)
-            # str 0 reg 7 0 0 (pstr)
-            code_out.append("SUB 7 7 0 1 0")
-            code_out.append(f"STR 0 {line[1]} 7 0 0")
-
-        elif line[0] == "POP":
-            # lod reg 0 7 0 0 (plod)
-            # add 7 7 0 1 0 (addi/inc)
-            code_out.append(f"LOD {line[1]} 0 7 0 0")
-            code_out.append("ADD 7 7 0 1 0")
-
-        elif line[0] == "MOV":
-            # add reg reg 0 0 0
-            code_out.append(f"ADD {line[1]} {line[2]} 0 0 0")
-
-        elif line[0] == "OR":
-            # in: OR dest a b
-            # nor dest a b 0 0
-            # nor dest dest 0 0 0 (not)
-            code_out.append(f"NOR {line[1]} {line[2]} {line[3]} 0 0")
-            code_out.append(f"NOR {line[1]} {line[1]} 0 0 0")
-
-        #  LSH = add a a a
-
-        #  NEG = sub a r0 a
-
-        #  NOT = nor 0 a
-
-        #  elif line[0] == "PBGE": # (branch to pointer)
-            # sub 0 a b 0 0
-            # brnch 0 0 poi 0 c
-
-    #  BGE - sub(a,b) c
-        elif line[0] == "BGE":
-            # sub 0 B C 0 0
-            # brnch 0 0 0 A c
-            code_out.append("SUB")
-            code_out.append("BRNCH")
-
-    #  BRL = sub a b, nc and nz
-        elif line[0] == "BRL":
-            # sub 0 A B 0 0
-            # brnch 0 0 0 A nc&nz
-            code_out.append(f"SUB 0 {line[2]} {line[3]} 0 0")
-            code_out.append(f"BRNCH 0 0 0 {line[1]} nc&nz")
-
-            #  BRG - sub(a,b) c and nz
-        elif line[0] == "":
-            #
-            code_out.append("")
-            code_out.append("")
-
-    #  BRE - sub(a,b) c and z
-        elif line[0] == "":
-            #
-            code_out.append("")
-            code_out.append("")
-
-#  BNE - sub(a,b) nz
-        elif line[0] == "":
-            #
-            code_out.append("")
-            code_out.append("")
-
-    #  BLE = BGE a c b
-        elif line[0] == "":
-            #
-            code_out.append("")
-
-    #  JMP = bge p 0 0
-        elif line[0] == "JMP":
-            # add 0 0 0 0 0  - set zero flag
-            # brnch 0 0 0 imm z
-            code_out.append("ADD 0 0 0 0 0")
-            code_out.append(f"BRNCH 0 0 0 {line[1]} z")
-
-
-#  BRC - add(a,b) c
-        elif line[0] == "":
-            #
-            code_out.append("")
-            code_out.append("")
-
-#  BNC - add(a,b) nc
-        elif line[0] == "":
-            #
-            code_out.append("")
-            code_out.append("")
-
-#  BRZ - add a 0, z
-        elif line[0] == "BRZ":
-            # add 0 B 0 0 0
-            # brnch 0 0 0 A z
-            code_out.append(f"ADD 0 {line[2]} 0 0 0")
-            code_out.append(f"BRNCH 0 0 0 {line[1]} z")
-
-#  BNZ - add a 0, nz
-        elif line[0] == "":
-            #
-            code_out.append(f"")
-            code_out.append(f"")
-
-#  BRN - add a a, c
-        elif line[0] == "":
-            #
-            code_out.append(f"")
-            code_out.append(f"")
-
-#  BRP - add a a, nc
-        elif line[0] == "":
-            #
-            code_out.append(f"")
-            code_out.append(f"")
-
-#  BOD - rsh a, nc
-        elif line[0] == "":
-            #
-            code_out.append(f"")
-            code_out.append(f"")
-
-#  BEV - rsh a, c
-        elif line[0] == "":
-            #
-            code_out.append(f"")
-            code_out.append(f"")
-    #  NOP = add 0 0 0
-    #  CAL = push ~+2, jump
-        elif line[0] == "CAL":
-            # imm 6 0 0 .ret_addr 0
-            # sub 7 7 0 1 0
-            # str 0 6 7 0 0
-            # brnch 0 0 0 A nz - zero flag is unset after sub instr.
-            # .ret_addr
-            lbl += 123
-            code_out.append(f"IMM 6 0 0 .return_addr_{lbl} 0")
-            code_out.append(f"SUB 7 7 0 1 0")
-            code_out.append(f"STR 0 6 7 0 0")
-            code_out.append(f"BRNCH 0 0 0 {line[1]} nz")
-            code_out.append(f".return_addr_{lbl}")
-
-    #  RET = pop temp, jump temp
-        elif line[0] == "RET":
-            # lod 6 0 7 0 0
-            # add 7 7 0 1 0
-            # add 0 0 0 0 0
-            # brnch 0 0 6 0 z
-            code_out.append("LOD 6 0 7 0 0")
-            code_out.append("ADD 7 7 0 1 0")
-            code_out.append(f"ADD 0 0 0 0 0")
-            code_out.append(f"BRNCH 0 0 6 0 z")
-
-#  HLT = msc set halt bit
-        elif line[0] == "HLT":
-            # msc 0 0 0 0 1
-            code_out.append("MSC 0 0 0 0 1")
-    #  CPY = lod, str
-#  MSC - set status bits - halt bit, ignore wait bit?, interrupt mask bit
-#  BRNCH - 7 conditions: z, nz, c, nc, nc&nz, c&z, c&nz,
-    return code_out
-
-
-def parse_labels(code_in: str):
-    idx = 0
-    code_out = []
+
+def link(code):
+    """ Assign addresses. Returns (instructions, labels, source_labels),
+    source_labels leaves out the labels made up by the macro expander. """
+    instructions = []
     labels = {}
-    for line in code_in:
-        #  tmp.append(f"{idx} {line}")
-        if line[0][0] != ".":
-            idx += 1
-            code_out.append(line)
+    source = {}
+    for item in code:
+        if isinstance(item, Label):
+            if item.name in labels:
+                raise CompileError(f"Label {item.name} defined twice",
+                                   item.location)
+            labels[item.name] = len(instructions)
+            if not item.generated:
+                source[item.name] = len(instructions)
         else:
-            labels[line] = idx
-    return code_out, labels
-
-
-def replace_labels(code_in, labels_dict):
-    code_out = []
-    for line in code_in:
-        line = line.split()
-        nline = ""
-        for word in line:
-            if word[0] == ".":
-                nline += str(labels_dict[word])
-                nline += " "
-            elif word[0] != ".":
-                nline += word
-                nline += " "
-        code_out.append(nline)
-
-    return code_out
-
-
-def replace_addresses(code_in, dev_dict, heap_start):
-    code_out = []
-    for line in code_in:
-        line = line.split()
-        nline = ""
-        for word in line:
-            if word[0] == "%":
-                nline += str(dev_dict[word])
-                nline += " "
-            elif word[0] == "#":
-                nline += str(int(word[1:]) + heap_start)
-                nline += " "
-            elif word[0] == "R":
-                nline += str(int(word[1:]))
-                nline += " "
-            else:
-                nline += word
-                nline += " "
-        code_out.append(nline)
-
-    return code_out
+            instructions.append(item)
+    return instructions, labels, source
+
+
+def sets_zero(instruction):
+    """ True for an ADD or SUB of R0 and 0, it always sets the zero flag
+    since R0 reads as 0. """
+    return instruction.opcode in ("ADD", "SUB") \
+        and instruction.fields[1:4] == ["0", "0", "0"]
+
+
+def reachable(instructions, labels, entry=0):
+    """ Addresses of the instructions execution can get to from entry.
+
+    Control follows fall-through and branches to labels. The only
+    indirect branch, the one in RET, goes to a return address some CAL
+    loaded with IMM, so any label a reachable instruction refers to counts
+    as reached. HLT doesn't fall through and neither does a BRNCH z right
+    after sets_zero() (JMP, RET), unless a label lets other code jump in
+    between.
+    """
+    targets = set(labels.values())
+    seen = set()
+    todo = [entry]
+    while todo:
+        addr = todo.pop()
+        if addr in seen or addr >= len(instructions):
+            continue
+        seen.add(addr)
+        ins = instructions[addr]
+        for field in ins.fields:
+            if isinstance(field, Operand) and field.kind == LABEL \
+                    and field.text in labels:
+                todo.append(labels[field.text])
+
+        cnd = ins.fields[4]
+        if ins.opcode == "MSC" and cnd == "1":
+            continue
+        if ins.opcode == "BRNCH" and (
+                cnd == "0" or cnd == "z" and addr not in targets and addr > 0
+                and sets_zero(instructions[addr - 1])):
+            continue
+        todo.append(addr + 1)
+    return seen
+
+
+def strip_dead_code(code, main_file):
+    """ Remove the library instructions that can't be reached from the
+    start of the program, the code of main_file is kept as written.
+    Returns (code, dropped), dropped maps library files to the number of
+    instructions removed from them. """
+    instructions, labels, _ = link(code)
+    live = reachable(instructions, labels)
+    kept = []
+    dropped = {}
+    addr = 0
+    for item in code:
+        if isinstance(item, AsmInstruction):
+            addr += 1
+            name = item.location.file
+            if addr - 1 not in live and name != main_file:
+                dropped[name] = dropped.get(name, 0) + 1
+                continue
+        kept.append(item)
+    return kept, dropped
+
+
+def link_program(code, filename, libraries, strip=True, optimize=False,
+                 word_size=8):
+    """ link() the code of filename and its libraries, after
+    strip_dead_code() if strip is set and liboptimizer.optimize() if
+    optimize is. Returns (instructions, labels, source_labels, dropped,
+    optimizations), dropped has an entry for every library. """
+    dropped = {}
+    optimizations = {}
+    if strip:
+        code, dropped = strip_dead_code(code, filename)
+    if optimize:
+        # Imported here, liboptimizer builds on this module.
+        from liboptimizer import optimize as optimize_code
+        code, optimizations = optimize_code(code, word_size)
+    instructions, labels, source = link(code)
+    return (instructions, labels, source,
+            {path: dropped.get(path, 0) for path in libraries},
+            optimizations)
+
+
+def resolve(instruction, labels, devices, heap_start):
+    """ Opcode and field texts of instruction in the .a format. """
+    return [instruction.opcode] + [
+        field if isinstance(field, str)
+        else field.resolve(labels, devices, heap_start, instruction.location)
+        for field in instruction.fields]
+
+
+def check_range(fields, word_size, location):
+    """ Raise CompileError when the immediate of resolved fields doesn't
+    fit in a word or isn't a number. """
+    try:
+        imm = int(fields[4])
+    except ValueError:
+        raise CompileError(f"Bad immediate {fields[4]}", location) from None
+    if not 0 <= imm < 2**word_size:
+        raise CompileError(f"Immediate {imm} doesn't fit in {word_size} "
+                           f"bits", location)
+
+
+def emit(fields):
+    """ One .a line. """
+    return " ".join(fields) + " "
+
+
+def compile_options(devices=None, heap_start=None, word_size=8, strip=True,
+                    optimize=False):
+    """ CompileOptions, the memory map defaults to the one of a
+    word_size bit DRCv2System. """
+    if devices is None:
+        devices = dict(DEVICES)
+    if heap_start is None:
+        heap_start = heap_start_of(word_size)
+    return CompileOptions(devices, heap_start, word_size, strip, optimize)
+
+
+def compile_file(filename, libdir, devices=None, heap_start=None, cache=None,
+                 strip=True, optimize=False, word_size=8):
+    """ Compile a source file into a CompiledProgram, through cache if
+    given. strip removes unreachable library code, optimize runs the
+    peephole optimizer. devices and heap_start default to the memory map
+    of a word_size bit machine. """
+    options = compile_options(devices, heap_start, word_size, strip,
+                              optimize)
+    if cache is not None:
+        return cache.compile_file(filename, libdir, options)
+    code, libraries = load_program_ir(filename, libdir)
+    return build(code, filename, libraries, options)
+
+
+def build(code, filename, libraries, options):
+    """ Link and emit expanded code into a CompiledProgram. """
+    instructions, labels, source, dropped, optimizations = link_program(
+        code, filename, libraries, options.strip, options.optimize,
+        options.word_size)
+    lines = []
+    for ins in instructions:
+        fields = resolve(ins, labels, options.devices, options.heap_start)
+        check_range(fields, options.word_size, ins.location)
+        lines.append(emit(fields))
+    return CompiledProgram(lines, labels, source,
+                           [ins.location for ins in instructions], libraries,
+                           dropped, optimizations)
 
 
 def save_file(filename, code):
@@ -329,25 +454,115 @@ def save_file(filename, code):
             f.write(line + "\n")
 
 
-def include_includes(code_in, libdir):
-    lib_code = []
-    code_out = []
-    for line in code_in:
+CACHE_DIR = ".drc_cache"
 
-        if line and line.split()[0] == "@INCLUDE":
-            libname = libdir + line.split()[1]
-            try:
-                with open(libname, "r") as lib:
-                    for line in lib:
-                        lib_code.append(line.strip())
-            except FileNotFoundError:
-                print(f"File {libname} not found!")
-                quit(1)
-        else:
-            code_out.append(line)
+# Part of every cache key, bump it when the IR classes, MACROS or the
+# output of the compiler change.
+CACHE_VERSION = 4
+
+
+def digest(*parts):
+    """ Hex sha256 of parts, each str or bytes. """
+    h = hashlib.sha256(str(CACHE_VERSION).encode())
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        h.update(len(part).to_bytes(8, "little"))
+        h.update(part)
+    return h.hexdigest()
 
-    code_out.append("////begin library code////")
-    code_out += lib_code
-    code_out.append("////end library code////")
 
-    return code_out
+def read_bytes(filename, location=None):
+    """ Raw contents of a source file, for hashing. """
+    try:
+        with open(filename, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        raise CompileError(f"File {filename} not found!", location) from None
+
+
+class CompileCache():
+    """ On-disk cache of compiled programs and parsed libraries.
+
+    Entries are pickle files named by a content hash:
+    - ir: parse_file() output of a library, keyed by its path and text,
+      shared by every program including it.
+    - deps: libraries a source includes, keyed by path, text and libdir.
+    - program: CompiledProgram, keyed by the deps key, the text of every
+      library listed there and the CompileOptions.
+    A file that can't be read back is a miss.
+    """
+    def __init__(self, directory=CACHE_DIR):
+        self.directory = directory
+        # Program lookups served from the cache and compiled.
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, kind, key):
+        return os.path.join(self.directory, f"{kind}-{key}.pickle")
+
+    def get(self, kind, key):
+        """ Cached value or None. """
+        try:
+            with open(self.path(kind, key), "rb") as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+            return None
+
+    def put(self, kind, key, value):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(kind, key)
+        temp = f"{path}.{os.getpid()}.tmp"
+        with open(temp, "wb") as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, path)
+
+    def parse_file(self, filename):
+        """ parse_file(), cached. """
+        text = read_bytes(filename)
+        key = digest(filename, text)
+        result = self.get("ir", key)
+        if result is None:
+            result = parse_file(filename, text.decode().splitlines())
+            self.put("ir", key, result)
+        return result
+
+    def program_key(self, deps_key, libraries, options):
+        """ Key of a compiled program, None if a library is gone. """
+        parts = [deps_key, repr(options._replace(
+            devices=sorted(options.devices.items())))]
+        for path in libraries:
+            try:
+                parts += [path, read_bytes(path)]
+            except CompileError:
+                return None
+        return digest(*parts)
+
+    def clear(self):
+        """ Remove every cache file. """
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith(".pickle"):
+                os.remove(os.path.join(self.directory, name))
+
+    def compile_file(self, filename, libdir, options):
+        """ compile_file(), served from the cache when neither the source,
+        the libraries it includes nor the settings changed. """
+        deps_key = digest(filename, read_bytes(filename), libdir)
+        libraries = self.get("deps", deps_key)
+        if libraries is not None:
+            key = self.program_key(deps_key, libraries, options)
+            program = self.get("program", key) if key else None
+            if program is not None:
+                self.hits += 1
+                return program
+
+        self.misses += 1
+        code, libraries = load_program_ir(filename, libdir, self)
+        program = build(code, filename, libraries, options)
+        self.put("deps", deps_key, libraries)
+        key = self.program_key(deps_key, libraries, options)
+        if key:
+            self.put("program", key, program)
+        return program
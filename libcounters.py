@@ -0,0 +1,90 @@
+""" Hardware style performance counters for DRC v.2 programs.
+
+PerfCounters is a step hook keeping every counter in one preallocated
+array, COUNTERS names its slots: retired instructions, stall ticks spent
+waiting for a device, branches taken and not taken, RAM and device
+accesses, then one retired count per opcode. Like the profiler nothing
+is installed unless counting is enabled, so the fast run() loop stays
+untouched otherwise.
+
+    counters = system.enable_counters()
+    system.run(max_cycles=10000)
+    print(counters.as_dict())
+
+Counters only count forwards, stepping back through the history leaves
+them as they are.
+"""
+from array import array
+
+from libcpu import OPCODES, OP_LOD, OP_STR, OP_BRNCH, COND_PREDICATES
+
+
+COUNTERS = ("cycles", "stalls", "branches_taken", "branches_not_taken",
+            "ram_reads", "ram_writes", "device_reads", "device_writes") \
+    + tuple("retired_" + opcode for opcode in OPCODES)
+(CYCLES, STALLS, BRANCHES_TAKEN, BRANCHES_NOT_TAKEN,
+ RAM_READS, RAM_WRITES, DEVICE_READS, DEVICE_WRITES) = range(8)
+# Slot of the retired count of opcode n is RETIRED + n.
+RETIRED = 8
+
+# Slot counting a memory access, by (opcode, is a device).
+ACCESS = {(OP_LOD, False): RAM_READS, (OP_LOD, True): DEVICE_READS,
+          (OP_STR, False): RAM_WRITES, (OP_STR, True): DEVICE_WRITES}
+
+
+class PerfCounters():
+    """ Step hook filling a counter block, see COUNTERS. """
+    def __init__(self, system):
+        self.system = system
+        self.block = array("Q", bytes(8 * len(COUNTERS)))
+        self.pending = None
+
+    def reset(self):
+        """ Zero all counters. """
+        for idx in range(len(self.block)):
+            self.block[idx] = 0
+
+    def before(self, pc, instruction):
+        # Operands are read before the instruction can overwrite them.
+        opcode, _, _, src_b, imm, cnd = instruction
+        system = self.system
+        if opcode == OP_LOD or opcode == OP_STR:
+            addr = imm | system.registers[src_b]
+            self.pending = ACCESS[opcode, system.devices[addr] is not None]
+        elif opcode == OP_BRNCH:
+            status = system.status_reg
+            self.pending = BRANCHES_TAKEN \
+                if COND_PREDICATES[cnd](status["zero_flag"],
+                                        status["carry_flag"]) \
+                else BRANCHES_NOT_TAKEN
+        else:
+            self.pending = None
+
+    def after(self, pc, instruction):
+        block = self.block
+        if self.system.status_reg["wait_bit"]:
+            block[STALLS] += 1
+            return
+        block[CYCLES] += 1
+        block[RETIRED + instruction[0]] += 1
+        if self.pending is not None:
+            block[self.pending] += 1
+
+    def __getitem__(self, name):
+        return self.block[COUNTERS.index(name)]
+
+    def as_dict(self):
+        """ Counter values by name, in COUNTERS order. """
+        return dict(zip(COUNTERS, self.block))
+
+    def as_array(self):
+        """ Copy of the counter block, indexed like COUNTERS. """
+        return array("Q", self.block)
+
+
+def format_counters(counters, skip_zero=True):
+    """ One "name value" line per counter of an as_dict() result. """
+    width = max(len(name) for name in counters)
+    return "\n".join(f"{name:<{width}} {value:>12}"
+                     for name, value in counters.items()
+                     if value or not skip_zero)
@@ -1,38 +1,119 @@
 """ test libcpu """
-from random import randint
+from array import array
+from collections import deque
+from concurrent.futures import Future
+from random import Random
+from time import perf_counter
+
+
+OPCODES = ("ADD", "SUB", "RSH", "INC", "DEC", "NOR",
+           "AND", "LOD", "STR", "IMM", "MSC", "BRNCH")
+(OP_ADD, OP_SUB, OP_RSH, OP_INC, OP_DEC, OP_NOR,
+ OP_AND, OP_LOD, OP_STR, OP_IMM, OP_MSC, OP_BRNCH) = range(len(OPCODES))
+
+CONDITIONS = ("0", "z", "nz", "c", "nc", "nc&nz", "c&z", "c&nz", "1")
+(COND_ALWAYS, COND_Z, COND_NZ, COND_C, COND_NC,
+ COND_NC_NZ, COND_C_Z, COND_C_NZ, COND_HALT) = range(len(CONDITIONS))
+
+# Word sizes a DRCv2System can be built with.
+WORD_SIZES = (8, 12, 16)
+
+
+def heap_start(bits=8):
+    """ First RAM address, the quarter of the address space below it is
+    the device window. """
+    return 2**(bits - 2)
+
+
+# Memory map: peripherals live below the heap start, RAM above it.
+CONSOLE_ADDR = 2
+RNG_ADDR = 40
+HEAP_START = heap_start(8)
+
+# Random values the RNG device generates at a time.
+RNG_BLOCK = 4096
+
+# Console output values kept, newest first.
+CONSOLE_HISTORY = 1024
+
+# Unused ROM cells decode to a harmless MSC.
+EMPTY_INSTRUCTION = (OP_MSC, 0, 0, 0, 0, COND_ALWAYS)
+
+# Reasons returned by DRCv2System.run().
+EXIT_HALT = "halt"
+EXIT_CYCLES = "max_cycles"
+EXIT_PC = "until_pc"
+EXIT_WAIT = "wait"
+EXIT_BREAK = "break"
 
 
 class DRCv2System():
-    """ doc """
-    def __init__(self):
+    """ DRC v.2 machine with word_size bit registers, memory cells,
+    addresses and ROM addresses, see WORD_SIZES. seed makes the RNG
+    device repeat the same values every run, None seeds it from the OS. """
+    def __init__(self, word_size=8, seed=None):
+        if word_size not in WORD_SIZES:
+            raise ValueError(f"Unsupported word size: {word_size}")
         self.program_counter = 0
-        self.word_size = 8
+        self.word_size = word_size
+        self.heap_start = heap_start(word_size)
+        self.seed = seed
         self.alu = ALU(self.word_size)
+        self.alu_add = self.alu.tables.add
+        self.alu_sub = self.alu.tables.sub
+        self.alu_nor = self.alu.tables.nor
+        self.alu_and = self.alu.tables.and_
+        self.alu_rsh = self.alu.tables.rsh
         self.program = []
         self.registers = [0]
         self.status_reg = {}
+        self.memory = bytearray()
+        self.ram = memoryview(self.memory)
         self.devices = []
         self.initialise_regs()
         self.initialise_devices()
         self.last_written = None
-        self.ign_wait = False
+        self.dirty_cells = set()
+        self.cycles = 0
+        # Host seconds spent stalled on devices, see waited().
+        self.wait_time = 0.0
+        self.wait_since = None
+        self.translator = None
+        self.history = None
+        self.trace = None
+        self.profiler = None
+        self.counters = None
+        self.breakpoints = None
+        self.hooks = []
+        self.handlers = (self.exec_add, self.exec_sub, self.exec_rsh,
+                         self.exec_inc, self.exec_dec, self.exec_nor,
+                         self.exec_and, self.exec_lod, self.exec_str,
+                         self.exec_imm, self.exec_msc, self.exec_brnch)
 
     def initialise_devices(self):
-        """ doc """
-        for i in range(64):
-            self.devices.append(Device(f"dev{i}", False, None))
-
-        self.devices[40] = Rng()
-        self.devices[2] = Console()
-
-        for i in range(64, 256):
-            self.devices.append(Device(f"RAM cell {i-64}", False, None))
+        """ Set up the address space.
+
+        memory holds every address as one bytearray, or an array of 16
+        bit cells for words wider than 8 bits, ram is a view of its part
+        above heap_start. devices is the address decode table: None for
+        plain memory cells, the peripheral object otherwise.
+        """
+        size = 2**self.word_size
+        if self.word_size <= 8:
+            self.memory = bytearray(size)
+        else:
+            self.memory = array("H", bytes(2 * size))
+        self.ram = memoryview(self.memory)[self.heap_start:]
+        self.devices = [None] * size
+
+        self.devices[RNG_ADDR] = Rng(bits=self.word_size, seed=self.seed)
+        self.devices[CONSOLE_ADDR] = Console(bits=self.word_size)
 
     def initialise_regs(self):
         """ doc """
         i = 1
         while i < 8:
-            self.registers.append(None)
+            self.registers.append(0)
             i += 1
         self.registers[7] = 0
         self.status_reg = {"halt_bit": False,
@@ -44,152 +125,433 @@ class DRCv2System():
             self.program = load_program(self.word_size, filename)
         except FileNotFoundError:
             print(f"File {filename} not found!")
+        if self.translator is not None:
+            self.translator.invalidate()
+        if self.history is not None:
+            self.enable_history(self.history.interval, self.history.keep)
+        if self.profiler is not None:
+            self.profiler.reset()
+        if self.counters is not None:
+            self.counters.reset()
+
+    def set_engine(self, engine="interpreter"):
+        """ Select how run() executes code: "interpreter" or "blocks". """
+        if engine == "interpreter":
+            self.translator = None
+        elif engine == "blocks":
+            # Imported here, libblocks depends on this module.
+            from libblocks import BlockTranslator
+            self.translator = BlockTranslator(self)
+        else:
+            raise ValueError(f"Unknown engine: {engine}")
 
     def get_next_state(self):
-        """ doc """
+        """ Execute a single instruction. """
         self.registers[0] = 0
-        instruction = self.program[self.program_counter]
-        self.last_written = None
-
-        if self.status_reg["wait_bit"] == True:
-            return
-
-
-        opcode = instruction["opcode"]
-        dest = int(instruction["dest_reg"])
-        src_a = int(instruction["src_a_reg"])
-        src_b = int(instruction["src_b_reg"])
-        imm = int(instruction["immediate"])
-        cnd = instruction["condition"]
-
-        if opcode == "MSC" and cnd == "1":
-            self.status_reg["halt_bit"] = True
-
-        elif opcode == "ADD":
-            rslt = self.alu.add_(self.registers[src_a], imm | self.registers[src_b])
-            self.registers[dest] = rslt[0]
-            self.status_reg["carry_flag"] = rslt[1]
-            self.status_reg["zero_flag"] = rslt[2]
-
-        elif opcode == "SUB":
-            rslt = self.alu.sub_(self.registers[src_a], imm | self.registers[src_b])
-            self.registers[dest] = rslt[0]
-            self.status_reg["carry_flag"] = rslt[1]
-            self.status_reg["zero_flag"] = rslt[2]
-
-        elif opcode == "RSH":
-            result = self.alu.rsh_(self.registers[src_a])
-            self.registers[dest] = result[0]
-            self.status_reg["carry_flag"] = result[1]
-
-        elif opcode == "INC":
-            self.registers[dest] = self.alu.add_(self.registers[src_a], 1)[0]
-
-        elif opcode == "DEC":
-            self.registers[dest] = self.alu.sub_(self.registers[src_a], 1)[0]
-
-        elif opcode == "NOR":
-            self.registers[dest] = \
-                self.alu.nor_(self.registers[src_a], imm | self.registers[src_b])
 
-        elif opcode == "AND":
-            self.registers[dest] = \
-                self.alu.and_(self.registers[src_a], self.registers[src_b])
-
-        elif opcode == "LOD":
-            addr = imm | self.registers[src_b]
-            if addr == 2 and not self.ign_wait:
-                self.status_reg["wait_bit"] = True
-                self.ign_wait = True
-                return
-            self.registers[dest] = \
-                self.devices[addr].read()
-            self.ign_wait = False
-
-
-
-        elif opcode == "STR":
-            addr = imm | self.registers[src_b]
-            self.devices[addr].write(self.registers[src_a])
-            self.last_written = addr
-
-        elif opcode == "IMM":
-            self.registers[dest] = imm
-
-        elif opcode == "BRNCH":
-            if eval_cond(cnd, self.status_reg):
-                self.program_counter = imm | self.registers[src_b]
-            else:
-                self.program_counter += 1
+        pc = self.program_counter
+        instruction = self.program[pc]
+        for hook in self.hooks:
+            hook.before(pc, instruction)
+        self.last_written = None
 
-        if self.status_reg["halt_bit"] is False and opcode != "BRNCH":
+        opcode, dest, src_a, src_b, imm, cnd = instruction
+        if not self.handlers[opcode](dest, src_a, src_b, imm, cnd) \
+                and self.status_reg["halt_bit"] is False:
             self.program_counter += 1
         self.program_counter = self.program_counter % (2**self.word_size)
         self.registers[0] = 0
-
+        if not self.status_reg["wait_bit"]:
+            self.cycles += 1
+
+        for hook in self.hooks:
+            hook.after(pc, instruction)
+
+    def run(self, max_cycles=None, until_halt=True, until_pc=None):
+        """ Execute instructions until a stop condition is met.
+
+        Stops after max_cycles instructions, when the halt bit gets set
+        (if until_halt), when the PC lands on until_pc, when the CPU
+        starts waiting for a device or at a breakpoint, see libdebug.
+        Returns (exit_reason, cycles) where exit_reason is one of the
+        EXIT_* constants.
+        """
+        if max_cycles is None and until_pc is None and not until_halt:
+            raise ValueError("run() needs at least one stop condition")
+        if self.breakpoints:
+            return self.breakpoints.run(max_cycles, until_halt, until_pc)
+        if self.hooks:
+            return self.run_stepwise(max_cycles, until_halt, until_pc)
+        if self.translator is not None:
+            return self.translator.run(max_cycles, until_halt, until_pc)
+
+        program = self.program
+        handlers = self.handlers
+        regs = self.registers
+        status = self.status_reg
+        pc_mod = 2**self.word_size
+        limit = -1 if max_cycles is None else max_cycles
+        cycles = 0
+        opcode = None
+        reason = EXIT_CYCLES
+
+        if status["halt_bit"] and until_halt:
+            return EXIT_HALT, 0
+
+        while cycles != limit:
+            regs[0] = 0
+            opcode, dest, src_a, src_b, imm, cnd = program[self.program_counter]
+            if handlers[opcode](dest, src_a, src_b, imm, cnd):
+                # Branch, halt or stall, the handler has set the PC.
+                if status["wait_bit"]:
+                    reason = EXIT_WAIT
+                    break
+                cycles += 1
+                if status["halt_bit"] and until_halt:
+                    reason = EXIT_HALT
+                    break
+            else:
+                self.program_counter = (self.program_counter + 1) % pc_mod
+                cycles += 1
+            if self.program_counter == until_pc:
+                reason = EXIT_PC
+                break
+
+        if opcode is not None and opcode != OP_STR:
+            self.last_written = None
+        regs[0] = 0
+        self.cycles += cycles
+        return reason, cycles
+
+    def wait_device(self):
+        """ Address of the device the CPU is stalled on, None while it
+        isn't waiting. """
+        if not self.status_reg["wait_bit"]:
+            return None
+        _, _, _, src_b, imm, _ = self.program[self.program_counter]
+        return imm | self.registers[src_b]
+
+    def on_ready(self, callback):
+        """ Call callback() once the device the CPU is stalled on can be
+        read, right away if it isn't stalled. It may be called from the
+        thread that feeds the device. """
+        addr = self.wait_device()
+        if addr is None:
+            callback()
+        else:
+            self.devices[addr].on_ready(callback)
+
+    def ready_future(self):
+        """ concurrent.futures.Future resolving to the address of the
+        device the CPU is stalled on once that can be read, see
+        on_ready(). Wrap it with asyncio.wrap_future() in event loops. """
+        future = Future()
+        addr = self.wait_device()
+
+        def resolve():
+            # The waiter may have given up and cancelled it.
+            if not future.done():
+                future.set_result(addr)
+        self.on_ready(resolve)
+        return future
+
+    def waited(self):
+        """ Host seconds spent stalled on devices, including the current
+        stall. Cycles only count executed instructions. """
+        if self.status_reg["wait_bit"] and self.wait_since is not None:
+            return self.wait_time + perf_counter() - self.wait_since
+        return self.wait_time
+
+    def take_dirty(self):
+        """ Memory addresses written since the last call, for views that
+        only want to redraw what changed. """
+        dirty = self.dirty_cells
+        self.dirty_cells = set()
+        return dirty
+
+    def run_stepwise(self, max_cycles=None, until_halt=True, until_pc=None):
+        """ run() through get_next_state(), so hooks see every instruction. """
+        status = self.status_reg
+        start = self.cycles
+
+        if status["halt_bit"] and until_halt:
+            return EXIT_HALT, 0
+
+        while self.cycles - start != max_cycles:
+            self.get_next_state()
+            if status["wait_bit"]:
+                return EXIT_WAIT, self.cycles - start
+            if status["halt_bit"] and until_halt:
+                return EXIT_HALT, self.cycles - start
+            if self.program_counter == until_pc:
+                return EXIT_PC, self.cycles - start
+        return EXIT_CYCLES, self.cycles - start
+
+    ######################
+    # step hooks
+    ######################
+    # A hook is an object with before(pc, instruction) and
+    # after(pc, instruction) methods, called around every instruction
+    # get_next_state() executes. While any hook is installed run() goes
+    # through get_next_state() instead of its fast paths.
+
+    def add_hook(self, hook):
+        """ Install a step hook. """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        """ Uninstall a step hook. """
+        self.hooks.remove(hook)
+
+    def enable_history(self, interval=1024, keep=64):
+        """ Start recording history for step_back() and goto_cycle().
+        Keeps the last keep checkpoints, taken every interval cycles. """
+        # Imported here, libhistory depends on this module.
+        from libhistory import History
+        self.disable_history()
+        self.history = History(self, interval, keep)
+        self.add_hook(self.history)
+
+    def disable_history(self):
+        """ Stop recording history and free it. """
+        if self.history is not None:
+            self.remove_hook(self.history)
+            self.history = None
+
+    def start_trace(self, filename):
+        """ Stream a binary trace of every executed instruction to
+        filename, see libtrace. """
+        # Imported here, libtrace depends on this module.
+        from libtrace import TraceWriter
+        self.stop_trace()
+        self.trace = TraceWriter(self, filename)
+        self.add_hook(self.trace)
+
+    def stop_trace(self):
+        """ Finish the trace file started by start_trace(). """
+        if self.trace is not None:
+            self.remove_hook(self.trace)
+            self.trace.close()
+            self.trace = None
+
+    def enable_profiler(self):
+        """ Start counting executions and stalls per address, see
+        libprofile. Returns the Profiler. """
+        # Imported here, libprofile depends on this module.
+        from libprofile import Profiler
+        self.disable_profiler()
+        self.profiler = Profiler(self)
+        self.add_hook(self.profiler)
+        return self.profiler
+
+    def disable_profiler(self):
+        """ Stop profiling and drop the counters. """
+        if self.profiler is not None:
+            self.remove_hook(self.profiler)
+            self.profiler = None
+
+    def enable_counters(self):
+        """ Start the performance counters, see libcounters. Returns the
+        PerfCounters. """
+        # Imported here, libcounters depends on this module.
+        from libcounters import PerfCounters
+        self.disable_counters()
+        self.counters = PerfCounters(self)
+        self.add_hook(self.counters)
+        return self.counters
+
+    def disable_counters(self):
+        """ Stop the performance counters and drop them. """
+        if self.counters is not None:
+            self.remove_hook(self.counters)
+            self.counters = None
+
+    def get_breakpoints(self):
+        """ Breakpoints and watchpoints of this system, see libdebug. """
+        if self.breakpoints is None:
+            # Imported here, libdebug depends on this module.
+            from libdebug import Breakpoints
+            self.breakpoints = Breakpoints(self)
+        return self.breakpoints
+
+    def step_back(self, count=1):
+        """ Undo the last count instructions. """
+        self.goto_cycle(max(self.cycles - count, 0))
+
+    def goto_cycle(self, cycle):
+        """ Move to the state after cycle instructions, backwards through
+        the history or forwards by running. """
+        if cycle > self.cycles:
+            self.run(max_cycles=cycle - self.cycles)
+            return
+        if self.history is None:
+            raise ValueError("History is not enabled")
+        self.history.goto_cycle(cycle)
+
+    ######################
+    # instruction handlers
+    ######################
+    # Every handler takes the pre-decoded operand fields and returns True
+    # when it has taken care of the program counter itself.
+
+    def exec_add(self, dest, src_a, src_b, imm, cnd):
+        """ ADD dest = a + (imm | b), sets carry and zero. """
+        regs = self.registers
+        status = self.status_reg
+        regs[dest], status["carry_flag"], status["zero_flag"] = \
+            self.alu_add[regs[src_a] << self.word_size | imm | regs[src_b]]
+
+    def exec_sub(self, dest, src_a, src_b, imm, cnd):
+        """ SUB dest = a - (imm | b), sets carry and zero. """
+        regs = self.registers
+        status = self.status_reg
+        regs[dest], status["carry_flag"], status["zero_flag"] = \
+            self.alu_sub[regs[src_a] << self.word_size | imm | regs[src_b]]
+
+    def exec_rsh(self, dest, src_a, src_b, imm, cnd):
+        """ RSH dest = a >> 1, sets carry. """
+        self.registers[dest], self.status_reg["carry_flag"] = \
+            self.alu_rsh[self.registers[src_a]]
+
+    def exec_inc(self, dest, src_a, src_b, imm, cnd):
+        """ INC dest = a + 1, flags untouched. """
+        self.registers[dest] = \
+            self.alu_add[self.registers[src_a] << self.word_size | 1][0]
+
+    def exec_dec(self, dest, src_a, src_b, imm, cnd):
+        """ DEC dest = a - 1, flags untouched. """
+        self.registers[dest] = \
+            self.alu_sub[self.registers[src_a] << self.word_size | 1][0]
+
+    def exec_nor(self, dest, src_a, src_b, imm, cnd):
+        """ NOR dest = ~(a | (imm | b)). """
+        regs = self.registers
+        regs[dest] = \
+            self.alu_nor[regs[src_a] << self.word_size | imm | regs[src_b]][0]
+
+    def exec_and(self, dest, src_a, src_b, imm, cnd):
+        """ AND dest = a & b. """
+        regs = self.registers
+        regs[dest] = self.alu_and[regs[src_a] << self.word_size | regs[src_b]][0]
+
+    def exec_lod(self, dest, src_a, src_b, imm, cnd):
+        """ LOD dest = device[imm | b], stalls while the console has no
+        input queued and executes again on the next step. """
+        addr = imm | self.registers[src_b]
+        device = self.devices[addr]
+        if device is None:
+            self.registers[dest] = self.memory[addr]
+        elif addr == CONSOLE_ADDR:
+            status = self.status_reg
+            if not device.ready():
+                if not status["wait_bit"]:
+                    status["wait_bit"] = True
+                    self.wait_since = perf_counter()
+                return True
+            if status["wait_bit"]:
+                status["wait_bit"] = False
+                if self.wait_since is not None:
+                    self.wait_time += perf_counter() - self.wait_since
+                    self.wait_since = None
+            self.registers[dest] = device.read()
+        else:
+            self.registers[dest] = device.read()
+
+    def exec_str(self, dest, src_a, src_b, imm, cnd):
+        """ STR device[imm | b] = a. """
+        addr = imm | self.registers[src_b]
+        device = self.devices[addr]
+        if device is None:
+            self.memory[addr] = self.registers[src_a]
+            self.dirty_cells.add(addr)
+        else:
+            device.write(self.registers[src_a])
+        self.last_written = addr
+
+    def exec_imm(self, dest, src_a, src_b, imm, cnd):
+        """ IMM dest = imm. """
+        self.registers[dest] = imm
+
+    def exec_msc(self, dest, src_a, src_b, imm, cnd):
+        """ MSC sets status bits, currently only the halt bit. """
+        if cnd == COND_HALT:
+            self.status_reg["halt_bit"] = True
+            return True
+
+    def exec_brnch(self, dest, src_a, src_b, imm, cnd):
+        """ BRNCH to imm | b if the condition holds. """
+        if COND_PREDICATES[cnd](self.status_reg["zero_flag"],
+                                self.status_reg["carry_flag"]):
+            self.program_counter = imm | self.registers[src_b]
+        else:
+            self.program_counter = (self.program_counter + 1) \
+                % 2**self.word_size
+        return True
 
     def dump_all(self):
         """ Print debug info to console. """
         print(f"PC: {self.program_counter}")
-        print(self.program[self.program_counter])
+        print(disassemble(self.program[self.program_counter]))
         print(self.status_reg)
         for reg in self.registers:
             print(reg)
         print()
         for dev in self.devices:
-            print(dev)
+            if dev is not None:
+                print(dev)
+        print(list(self.ram))
 
 
 def load_program(bits=8, filename="test.a"):
-    """ d """
-    with open(filename, "r") as infile:
-        lines = []
-        for line in infile:
-            lines.append(line.strip())
-
-        program = []
-        for i in range(2**bits):
-            empty_ins = {
-                "opcode": "MSC",
-                "dest_reg": 0,
-                "src_a_reg": 0,
-                "src_b_reg": 0,
-                "immediate": 0,
-                "condition": 0
-            }
-            program.append(empty_ins)
-        for i in range(len(lines)):
-            line = lines[i].split(" ")
-            new_ins = {
-                "opcode": line[0],
-                "dest_reg": line[1],
-                "src_a_reg": line[2],
-                "src_b_reg": line[3],
-                "immediate": line[4],
-                "condition": line[5]
-            }
-            program[i] = new_ins
+    """ Load an .a or a binary .drb file and decode it into a ROM of
+    2**bits instructions. """
+    # Imported here, librom depends on this module.
+    from librom import is_rom_image, read_rom, rom_program
+    if is_rom_image(filename):
+        return rom_program(read_rom(filename), bits)
+
+    instructions = read_assembly(filename, bits)
+    program = [EMPTY_INSTRUCTION] * 2**bits
+    program[:len(instructions)] = instructions
     return program
 
 
-class Device():
-    """ doc """
-    def __init__(self, label="dev", ro=False, val=None):
-        self.label = label
-        self.readonly = ro
-        self.val = val
-
-    def __str__(self):
-        return self.label + ", value=" + str(self.val)
-
-    def write(self, new_val):
-        """ doc """
-        if not self.readonly:
-            self.val = new_val
-
-    def read(self):
-        """ doc """
-        return self.val
+def read_assembly(filename, bits=8):
+    """ Decoded instructions of an .a file, without padding. ValueError
+    when one is malformed, its immediate doesn't fit in bits or there are
+    more than the ROM holds. """
+    with open(filename, "r") as infile:
+        lines = [line.strip() for line in infile]
+
+    if len(lines) > 2**bits:
+        raise ValueError(f"{filename} has {len(lines)} instructions, "
+                         f"the ROM holds {2**bits}")
+    instructions = []
+    for i, line in enumerate(lines):
+        instruction = decode_instruction(line.split(), i)
+        if not 0 <= instruction[4] < 2**bits:
+            raise ValueError(f"Immediate out of range at line {i}: {line}")
+        instructions.append(instruction)
+    return instructions
+
+
+def decode_instruction(fields, line_no=0):
+    """ Turn the six text fields of an .a line into a decoded tuple:
+    (opcode, dest_reg, src_a_reg, src_b_reg, immediate, condition). """
+    try:
+        opcode = OPCODES.index(fields[0])
+        cnd = CONDITIONS.index(fields[5])
+        return (opcode, int(fields[1]), int(fields[2]), int(fields[3]),
+                int(fields[4]), cnd)
+    except (ValueError, IndexError):
+        raise ValueError(f"Malformed instruction at line {line_no}: "
+                         f"{' '.join(fields)}") from None
+
+
+def disassemble(instruction) -> str:
+    """ Turn a decoded instruction back into its .a text form. """
+    opcode, dest, src_a, src_b, imm, cnd = instruction
+    return f"{OPCODES[opcode]} {dest} {src_a} {src_b} {imm} {CONDITIONS[cnd]}"
 
 
 def truncate_numbers(data: int, word_length=8) -> int:
@@ -204,8 +566,9 @@ support negative values:", data)
 
 class ALU():
     """ doc """
-    def __init__(self, bits=8):
+    def __init__(self, bits=8, tables=True):
         self.bits = bits
+        self.tables = get_alu_tables(bits) if tables else None
 
     def add_(self, a, b):
         """ doc """
@@ -214,7 +577,7 @@ class ALU():
             carry = True
         if a+b == 0:
             zero = True
-        result = truncate_numbers(a + b)
+        result = truncate_numbers(a + b, self.bits)
         return result, carry, zero
 
     def sub_(self, a, b):
@@ -235,16 +598,7 @@ class ALU():
 
     def nor_(self, a, b):
         """ doc """
-        arg_a = str(bin(a))[2:].zfill(self.bits)
-        arg_b = str(bin(b))[2:].zfill(self.bits)
-        r = ""
-        for i in range(self.bits):
-            if arg_a[i] == "0" and arg_b[i] == "0":
-                rslt += "1"
-            else:
-                rslt += "0"
-        rslt = int(rslt, base=2)
-        return r
+        return ~(a | b) & (2**self.bits - 1)
 
     def rsh_(self, a):
         """ doc """
@@ -255,25 +609,129 @@ class ALU():
         return a//2, carry
 
 
-def eval_cond(cnd: str, status_reg) -> bool:
-    """ doc """
-    zero = status_reg["zero_flag"]
-    carry = status_reg["carry_flag"]
-    return (cnd == "0")\
-        or (cnd == "z" and zero)\
-        or (cnd == "nz" and not zero)\
-        or (cnd == "c" and carry)\
-        or (cnd == "nc" and not carry)\
-        or (cnd == "nc&nz" and not carry and not zero)\
-        or (cnd == "c&z" and carry and zero)\
-        or (cnd == "c&nz" and carry and not zero)
+class ALUTables():
+    """ Precomputed ALU results for one word size.
+
+    add, sub, nor and and_ are indexed by (a << shift) | b and hold
+    (result, carry, zero) tuples, rsh is indexed by a and holds
+    (result, carry). Equal tuples are shared, so a table costs little
+    more than its list of references.
+    """
+    def __init__(self, bits):
+        ref = ALU(bits, tables=False)
+        size = 2**bits
+        canon = {}
+        self.shift = bits
+
+        def table(func):
+            out = []
+            for a in range(size):
+                for b in range(size):
+                    entry = func(a, b)
+                    out.append(canon.setdefault(entry, entry))
+            return out
+
+        self.add = table(ref.add_)
+        self.sub = table(ref.sub_)
+        self.nor = table(lambda a, b: flags_of(ref.nor_(a, b)))
+        self.and_ = table(lambda a, b: flags_of(ref.and_(a, b)))
+        self.rsh = [ref.rsh_(a) for a in range(size)]
+
+
+class ComputedTable():
+    """ Looks like an ALUTables list, computes func(a, b) for the index
+    instead of storing it. """
+    __slots__ = ("func", "shift", "mask")
+
+    def __init__(self, func, bits):
+        self.func = func
+        self.shift = bits
+        self.mask = 2**bits - 1
+
+    def __getitem__(self, idx):
+        return self.func(idx >> self.shift, idx & self.mask)
+
+
+class ComputedTables():
+    """ ALUTables stand-in for words too wide to tabulate, a 12 bit add
+    table alone would have 16M entries. """
+    def __init__(self, bits):
+        ref = ALU(bits, tables=False)
+        self.shift = bits
+        self.add = ComputedTable(ref.add_, bits)
+        self.sub = ComputedTable(ref.sub_, bits)
+        self.nor = ComputedTable(lambda a, b: flags_of(ref.nor_(a, b)), bits)
+        self.and_ = ComputedTable(lambda a, b: flags_of(ref.and_(a, b)), bits)
+        self.rsh = ComputedTable(lambda _, a: ref.rsh_(a), bits)
+
+
+def flags_of(result):
+    """ (result, carry, zero) for a logic op, which never carries. """
+    return result, False, result == 0
+
+
+# ALUTables by word size, shared by every ALU instance.
+ALU_TABLES = {}
+
+# Widest words that get real lookup tables, 2**(2 * bits) entries each.
+MAX_TABLE_BITS = 8
+
+
+def get_alu_tables(bits=8):
+    """ Build the lookup tables for bits the first time they are needed,
+    ComputedTables above MAX_TABLE_BITS. """
+    if bits not in ALU_TABLES:
+        if bits > MAX_TABLE_BITS:
+            ALU_TABLES[bits] = ComputedTables(bits)
+        else:
+            ALU_TABLES[bits] = ALUTables(bits)
+    return ALU_TABLES[bits]
+
+
+# Branch predicates, indexed by decoded condition, called as pred(zero, carry).
+# "1" only has a meaning for MSC (set halt bit), as a branch it never jumps.
+COND_PREDICATES = (
+    lambda zero, carry: True,
+    lambda zero, carry: bool(zero),
+    lambda zero, carry: not zero,
+    lambda zero, carry: bool(carry),
+    lambda zero, carry: not carry,
+    lambda zero, carry: not carry and not zero,
+    lambda zero, carry: bool(carry and zero),
+    lambda zero, carry: bool(carry and not zero),
+    lambda zero, carry: False,
+)
 
 
 class Rng():
-    """ doc """
-    def __init__(self, label="RNG", bits=8):
+    """ Random number device with its own generator, seeded with seed
+    (from the OS if None). Values are generated RNG_BLOCK at a time and
+    reads are served from that block. """
+    def __init__(self, label="RNG", bits=8, seed=None):
         self.label = label
         self.bits = bits
+        self.random = Random(seed)
+        self.block = b""
+        self.pos = 0
+
+    def seed(self, seed=None):
+        """ Restart the sequence from seed. """
+        self.random.seed(seed)
+        self.block = b""
+        self.pos = 0
+
+    def refill(self):
+        """ Generate the next block of values. """
+        if self.bits <= 8:
+            data = self.random.randbytes(RNG_BLOCK)
+            self.block = data if self.bits == 8 \
+                else bytes(val >> 8 - self.bits for val in data)
+        else:
+            shift = 16 - self.bits
+            self.block = array("H", self.random.randbytes(2 * RNG_BLOCK))
+            if shift:
+                self.block = array("H", (val >> shift for val in self.block))
+        self.pos = 0
 
     def __str__(self):
         return self.label + ", value=random :)"
@@ -283,35 +741,87 @@ class Rng():
         pass
 
     def read(self):
-        """ doc """
-        return randint(0, 2**self.bits-1)
+        """ Next random value. """
+        if self.pos == len(self.block):
+            self.refill()
+        val = self.block[self.pos]
+        self.pos += 1
+        return val
 
 
 class Console():
-    """ doc """
-    def __init__(self, label="Console", bits=8):
-        self.buffer = [None]
+    """ Console peripheral.
+
+    Values the program stores go to buffer, newest first, keeping the last
+    history of them (all of them if history is None). Values the program
+    loads come from a FIFO filled with push() or feed(); a load from an
+    empty FIFO stalls the CPU until on_ready() callbacks say there is
+    input again.
+    """
+    def __init__(self, label="Console", bits=8, history=CONSOLE_HISTORY):
+        self.buffer = deque(maxlen=history)
+        self.input = deque()
+        self.sources = deque()
+        self.waiters = []
         self.label = label
         self.bits = bits
-        self.is_ready = False
 
     def __str__(self):
-        return self.label + ": " + str(self.buffer[0])
+        return self.label + ": " + str(self.last())
+
+    def last(self):
+        """ Most recent output value, None before the first one. """
+        return self.buffer[0] if self.buffer else None
+
+    def push(self, val):
+        """ Queue one input value. """
+        self.input.append(val % 2**self.bits)
+        self.notify()
+
+    def feed(self, values):
+        """ Queue input values from any iterable, e.g. a list or a
+        generator. Iterables are consumed lazily, one value per read. """
+        self.sources.append(iter(values))
+        self.notify()
+
+    def on_ready(self, callback):
+        """ Call callback() once, as soon as a read would return input. """
+        if self.ready():
+            callback()
+        else:
+            self.waiters.append(callback)
+
+    def notify(self):
+        """ Run the on_ready() callbacks if there is input now. """
+        if self.waiters and self.ready():
+            waiters, self.waiters = self.waiters, []
+            for callback in waiters:
+                callback()
+
+    def feed_file(self, filename):
+        """ Queue the numbers in a text file, separated by whitespace or
+        commas. """
+        with open(filename, "r") as f:
+            self.feed([int(val) for val in f.read().replace(",", " ").split()])
+
+    def ready(self):
+        """ True when a read would return input. """
+        while not self.input and self.sources:
+            try:
+                self.input.append(next(self.sources[0]) % 2**self.bits)
+            except StopIteration:
+                self.sources.popleft()
+        return bool(self.input)
 
     def read(self):
-        """ doc """
-        #  prompt = f"{self.label}: Type a number: "
-        #  inp = input(prompt)
-        #  inp = randint(0, 255) ######### TEMPORARY FIX!!!!!!
-        #  from app import App
-        #  inp = App.prompt()
-        #  inp = int(inp) % 2**self.bits
-        #  self.buffer.insert(0, inp)
-        return self.buffer[0]
+        """ Next input value, None when nothing is queued. """
+        if self.ready():
+            return self.input.popleft()
+        return None
 
     def write(self, val):
         """ doc """
-        self.buffer.insert(0, val)
+        self.buffer.appendleft(val % 2**self.bits)
 
     #  def dump_all(self):
         #  """ doc """
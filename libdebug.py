@@ -0,0 +1,238 @@
+""" Breakpoints and watchpoints for DRC v.2 programs.
+
+Breakpoints keeps one flag table per kind of stop, indexed by address:
+PC breakpoints by ROM address, read and write watchpoints by memory or
+device address. A point may carry a condition like "R1 == 0" that has to
+hold for it to stop. DRCv2System.run() only hands over to
+Breakpoints.run() while at least one point is set, so the fast paths
+pay nothing otherwise.
+
+    points = system.get_breakpoints()
+    points.add(*parse_point(".gcd if R2 == 0", labels))
+    points.add(WATCH_WRITE, 70)
+    reason, _ = system.run()        # EXIT_BREAK, points.hit tells where
+
+A breakpoint stops before its instruction runs, a watchpoint right after
+the LOD or STR that touched its address.
+"""
+import operator
+from collections import namedtuple
+
+from libcpu import OP_LOD, OP_STR, EXIT_HALT, EXIT_CYCLES, EXIT_PC, EXIT_WAIT, \
+    EXIT_BREAK
+
+
+BREAK_PC = "pc"
+WATCH_READ = "read"
+WATCH_WRITE = "write"
+KINDS = (BREAK_PC, WATCH_READ, WATCH_WRITE)
+
+# Comparisons allowed in conditions.
+COMPARISONS = {"==": operator.eq, "!=": operator.ne, "<": operator.lt,
+               "<=": operator.le, ">": operator.gt, ">=": operator.ge}
+
+# Where a run stopped: kind of point, its address and the PC after the stop.
+Hit = namedtuple("Hit", "kind addr pc")
+
+# One comparison of a condition, e.g. R1 == 0 is Clause("R", 1, eq, 0).
+Clause = namedtuple("Clause", "source index compare value")
+
+
+def parse_number(text, names=None):
+    """ Address in text: a number, or a key of names like ".loop" or
+    "%NUMB". Labels may be given without their leading dot. """
+    names = names or {}
+    for name in (text, "." + text):
+        if name in names:
+            return names[name]
+    try:
+        return int(text, 0)
+    except ValueError:
+        raise ValueError(f"Unknown address or label: {text}") from None
+
+
+def parse_operand(text, word_size=8):
+    """ (source, index) of the left side of a comparison: a register R0
+    to R7 or SP, PC or a memory cell [addr] of a word_size bit system. """
+    text = text.upper()
+    if text == "SP":
+        return "R", 7
+    if text == "PC":
+        return "PC", 0
+    if len(text) == 2 and text[0] == "R" and text[1] in "01234567":
+        return "R", int(text[1])
+    if text.startswith("[") and text.endswith("]"):
+        addr = parse_number(text[1:-1])
+        if not 0 <= addr < 2**word_size:
+            raise ValueError(f"Address {addr} out of range")
+        return "M", addr
+    raise ValueError(f"Expected a register, PC or [address], got {text}")
+
+
+def parse_condition(text, word_size=8):
+    """ Clauses of a condition like "R1 == 0 and [70] > 3", all of which
+    have to hold. """
+    clauses = []
+    for part in text.split(" and "):
+        tokens = part.split()
+        if len(tokens) != 3 or tokens[1] not in COMPARISONS:
+            raise ValueError(f"Expected <operand> <comparison> <number>, "
+                             f"got {part.strip()!r}")
+        source, index = parse_operand(tokens[0], word_size)
+        clauses.append(Clause(source, index, COMPARISONS[tokens[1]],
+                              parse_number(tokens[2])))
+    return tuple(clauses)
+
+
+def parse_point(text, labels=None, devices=None, word_size=8):
+    """ (kind, addr, condition) of a point written as
+        [read|write] <address or label> [if <condition>]
+    e.g. ".modulo_loop if R1 == 0", "write 70" or "read %NUMB". Labels
+    name ROM addresses, devices memory addresses of a word_size bit
+    system. """
+    text, _, condition = text.partition(" if ")
+    words = text.split()
+    kind = BREAK_PC
+    if len(words) == 2 and words[0] in (WATCH_READ, WATCH_WRITE):
+        kind = words.pop(0)
+    if len(words) != 1:
+        raise ValueError(f"Expected [read|write] <address> [if <condition>], "
+                         f"got {text.strip()!r}")
+    names = labels if kind == BREAK_PC else devices
+    return (kind, parse_number(words[0], names),
+            parse_condition(condition, word_size) if condition.strip()
+            else None)
+
+
+def holds(condition, system):
+    """ True when every clause of condition holds for system. """
+    for source, index, compare, value in condition:
+        if source == "R":
+            current = system.registers[index]
+        elif source == "PC":
+            current = system.program_counter
+        else:
+            current = system.memory[index]
+        if not compare(current, value):
+            return False
+    return True
+
+
+class Breakpoints():
+    """ Flag tables of the set points and the conditions of those that
+    have one. hit is the Hit of the last stop, None before the first. """
+    def __init__(self, system):
+        self.system = system
+        size = 2**system.word_size
+        self.flags = {kind: bytearray(size) for kind in KINDS}
+        self.conditions = {}
+        self.count = 0
+        self.hit = None
+        self.resume = None
+
+    def __bool__(self):
+        return self.count > 0
+
+    def add(self, kind, addr, condition=None):
+        """ Set a point, replacing the condition of an existing one. """
+        table = self.flags[kind]
+        if not 0 <= addr < len(table):
+            raise ValueError(f"Address {addr} out of range")
+        if not table[addr]:
+            table[addr] = 1
+            self.count += 1
+        if condition:
+            self.conditions[kind, addr] = condition
+        else:
+            self.conditions.pop((kind, addr), None)
+
+    def remove(self, kind, addr):
+        """ Clear a point, if set. """
+        table = self.flags[kind]
+        if table[addr]:
+            table[addr] = 0
+            self.count -= 1
+        self.conditions.pop((kind, addr), None)
+
+    def toggle(self, kind, addr):
+        """ Set or clear a point without condition. Returns True when it
+        is set now. """
+        if self.flags[kind][addr]:
+            self.remove(kind, addr)
+            return False
+        self.add(kind, addr)
+        return True
+
+    def clear(self):
+        """ Remove every point. """
+        for table in self.flags.values():
+            table[:] = bytes(len(table))
+        self.conditions = {}
+        self.count = 0
+
+    def points(self):
+        """ (kind, addr, condition) of every set point. """
+        return [(kind, addr, self.conditions.get((kind, addr)))
+                for kind, table in self.flags.items()
+                for addr, flag in enumerate(table) if flag]
+
+    def triggers(self, kind, addr):
+        condition = self.conditions.get((kind, addr))
+        return condition is None or holds(condition, self.system)
+
+    def stop(self, kind, addr):
+        system = self.system
+        self.hit = Hit(kind, addr, system.program_counter)
+        if kind == BREAK_PC:
+            # Running again from here goes past the breakpoint.
+            self.resume = (system.program_counter, system.cycles)
+        return EXIT_BREAK
+
+    def run(self, max_cycles=None, until_halt=True, until_pc=None):
+        """ Same contract as DRCv2System.run(), also returning EXIT_BREAK
+        when a point stops it. """
+        system = self.system
+        status = system.status_reg
+        regs = system.registers
+        program = system.program
+        pc_flags = self.flags[BREAK_PC]
+        read_flags = self.flags[WATCH_READ]
+        write_flags = self.flags[WATCH_WRITE]
+        start = system.cycles
+
+        if status["halt_bit"] and until_halt:
+            return EXIT_HALT, 0
+
+        while system.cycles - start != max_cycles:
+            pc = system.program_counter
+            if pc_flags[pc] and self.resume != (pc, system.cycles) \
+                    and self.triggers(BREAK_PC, pc):
+                return self.stop(BREAK_PC, pc), system.cycles - start
+
+            opcode, _, _, src_b, imm, _ = program[pc]
+            addr = imm | regs[src_b]
+            system.get_next_state()
+            if status["wait_bit"]:
+                return EXIT_WAIT, system.cycles - start
+            self.resume = None
+            if opcode == OP_LOD and read_flags[addr] \
+                    and self.triggers(WATCH_READ, addr):
+                return self.stop(WATCH_READ, addr), system.cycles - start
+            if opcode == OP_STR and write_flags[addr] \
+                    and self.triggers(WATCH_WRITE, addr):
+                return self.stop(WATCH_WRITE, addr), system.cycles - start
+            if status["halt_bit"] and until_halt:
+                return EXIT_HALT, system.cycles - start
+            if system.program_counter == until_pc:
+                return EXIT_PC, system.cycles - start
+        return EXIT_CYCLES, system.cycles - start
+
+
+def describe(hit, labels=None):
+    """ Text like "breakpoint at 17 (.gcd)" for a Hit. """
+    if hit.kind == BREAK_PC:
+        names = [name for name, addr in (labels or {}).items()
+                 if addr == hit.addr]
+        return f"breakpoint at {hit.addr}" \
+            + (f" ({', '.join(names)})" if names else "")
+    return f"{hit.kind} watchpoint at {hit.addr}, pc {hit.pc}"
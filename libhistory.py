@@ -0,0 +1,151 @@
+""" Execution history for stepping a DRC v.2 system backwards.
+
+Every executed instruction appends one undo entry holding only the cells
+it may change: the PC, the flags, its destination register and the memory
+cell a STR writes to. Every interval cycles a full checkpoint of the
+machine is taken as a compact bytes snapshot. Going back restores the
+nearest checkpoint at or after the target and then applies at most
+interval undo entries, so both time and memory stay bounded.
+
+Peripheral side effects (console input and output, RNG draws) are not
+rewound.
+"""
+import struct
+from collections import deque
+
+from libcpu import OP_STR
+
+
+# Checkpoint header: cycle, pc, last written address (NOT_WRITTEN for
+# None), packed status bits and 8 registers.
+SNAPSHOT_HEADER = struct.Struct("<QHiB8H")
+NOT_WRITTEN = -1
+
+# Tri-state flags (None, False, True) are stored as 0, 1, 2.
+FLAG_CODES = {None: 0, False: 1, True: 2}
+FLAG_VALUES = (None, False, True)
+
+
+def pack_status(status):
+    """ Pack the status register into one int. """
+    return (FLAG_CODES[status["carry_flag"]]
+            | FLAG_CODES[status["zero_flag"]] << 2
+            | status["halt_bit"] << 4
+            | status["wait_bit"] << 5)
+
+
+def unpack_status(packed, status):
+    """ Inverse of pack_status(). """
+    status["carry_flag"] = FLAG_VALUES[packed & 3]
+    status["zero_flag"] = FLAG_VALUES[packed >> 2 & 3]
+    status["halt_bit"] = bool(packed >> 4 & 1)
+    status["wait_bit"] = bool(packed >> 5 & 1)
+
+
+class History():
+    """ Undo log plus periodic checkpoints, installed as a step hook. """
+    def __init__(self, system, interval=1024, keep=64):
+        self.system = system
+        self.interval = interval
+        self.keep = keep
+        self.checkpoints = deque()
+        self.entries = deque()
+        self.base = system.cycles
+        self.checkpoint()
+
+    def snapshot(self):
+        """ Full machine state as bytes. """
+        system = self.system
+        header = SNAPSHOT_HEADER.pack(
+            system.cycles, system.program_counter,
+            NOT_WRITTEN if system.last_written is None else system.last_written,
+            pack_status(system.status_reg),
+            *system.registers)
+        return header + bytes(system.memory)
+
+    def restore(self, blob):
+        """ Load a snapshot() back into the machine. """
+        system = self.system
+        fields = SNAPSHOT_HEADER.unpack_from(blob)
+        system.cycles = fields[0]
+        system.program_counter = fields[1]
+        system.last_written = None if fields[2] == NOT_WRITTEN else fields[2]
+        unpack_status(fields[3], system.status_reg)
+        system.registers[:] = fields[4:]
+        # Byte view, memory may be an array of wider cells.
+        memoryview(system.memory).cast("B")[:] = blob[SNAPSHOT_HEADER.size:]
+        system.dirty_cells.update(range(len(system.memory)))
+
+    def checkpoint(self):
+        """ Take a checkpoint and forget what fell out of the window. """
+        self.checkpoints.append((self.system.cycles, self.snapshot()))
+        if len(self.checkpoints) > self.keep:
+            self.checkpoints.popleft()
+            oldest = self.checkpoints[0][0]
+            while self.base < oldest:
+                self.entries.popleft()
+                self.base += 1
+
+    def before(self, pc, instruction):
+        """ Step hook: remember what the instruction is about to change. """
+        system = self.system
+        if system.cycles % self.interval == 0 \
+                and self.checkpoints[-1][0] != system.cycles:
+            self.checkpoint()
+
+        opcode, dest, src_a, src_b, imm, cnd = instruction
+        regs = system.registers
+        addr = NOT_WRITTEN
+        old_mem = None
+        if opcode == OP_STR:
+            addr = imm | regs[src_b]
+            if system.devices[addr] is None:
+                old_mem = system.memory[addr]
+        self.entries.append((pc, pack_status(system.status_reg),
+                             dest, regs[dest], addr, old_mem))
+
+    def after(self, pc, instruction):
+        """ Step hook: a stalled instruction did not execute, drop its entry. """
+        if self.system.status_reg["wait_bit"]:
+            self.entries.pop()
+
+    def undo(self):
+        """ Revert the most recent instruction. """
+        system = self.system
+        pc, packed, dest, old, addr, old_mem = self.entries.pop()
+        system.program_counter = pc
+        unpack_status(packed, system.status_reg)
+        system.registers[dest] = old
+        system.registers[0] = 0
+        if old_mem is not None:
+            system.memory[addr] = old_mem
+            system.dirty_cells.add(addr)
+        system.cycles -= 1
+        system.last_written = None
+
+    def goto_cycle(self, cycle):
+        """ Rewind the machine to the state it had after cycle instructions. """
+        system = self.system
+        if cycle < self.base:
+            raise ValueError(f"Cycle {cycle} is no longer in the history, "
+                             f"oldest is {self.base}")
+        if cycle > system.cycles:
+            raise ValueError(f"Cycle {cycle} has not been executed yet")
+
+        for cp_cycle, blob in self.checkpoints:
+            if cycle <= cp_cycle < system.cycles:
+                self.restore(blob)
+                break
+        while len(self.entries) > system.cycles - self.base:
+            self.entries.pop()
+        while system.cycles > cycle:
+            self.undo()
+
+        while self.checkpoints and self.checkpoints[-1][0] > cycle:
+            self.checkpoints.pop()
+        if not self.checkpoints:
+            self.checkpoint()
+
+        # Entries keep the address every STR wrote to.
+        if self.entries and self.entries[-1][4] != NOT_WRITTEN:
+            system.last_written = self.entries[-1][4]
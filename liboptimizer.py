@@ -0,0 +1,306 @@
+""" Peephole optimizer for DRC v.2 programs.
+
+optimize() rewrites the expanded code of libcompiler right before it is
+linked. It follows the carry and zero flags two ways: which values they
+are known to hold at every instruction (forwards), and which of them may
+still be read by a branch before they are set again (backwards). With
+that it
+- turns a BRNCH whose condition is known into an unconditional one, or
+  drops it when it can never jump;
+- drops instructions whose only effect is setting flags nobody reads,
+  like the ADD R0 that JMP and RET use to force the zero flag, and MOVs
+  of a register to itself;
+- points branches to a jump straight at that jump's target and drops
+  jumps to the next instruction.
+The passes repeat until nothing changes.
+
+Like strip_dead_code(), it assumes indirect branches only go to labels
+whose address some instruction takes, as RET does. Code branching to
+numeric addresses is left alone since instructions move.
+"""
+from libcompiler import Operand, AsmInstruction, LABEL, REG, IMM, link
+from libcpu import ALU
+
+
+CARRY = 1
+ZERO = 2
+ALL_FLAGS = CARRY | ZERO
+
+# Flags a BRNCH reads, by condition.
+FLAG_READS = {"0": 0, "z": ZERO, "nz": ZERO, "c": CARRY, "nc": CARRY,
+              "nc&nz": ALL_FLAGS, "c&z": ALL_FLAGS, "c&nz": ALL_FLAGS,
+              "1": 0}
+
+# Flags an instruction sets, by opcode.
+FLAG_WRITES = {"ADD": ALL_FLAGS, "SUB": ALL_FLAGS, "RSH": CARRY}
+
+# Branch conditions as predicates of (carry, zero), see libcpu.
+PREDICATES = {
+    "0": lambda carry, zero: True,
+    "z": lambda carry, zero: zero,
+    "nz": lambda carry, zero: not zero,
+    "c": lambda carry, zero: carry,
+    "nc": lambda carry, zero: not carry,
+    "nc&nz": lambda carry, zero: not carry and not zero,
+    "c&z": lambda carry, zero: carry and zero,
+    "c&nz": lambda carry, zero: carry and not zero,
+    "1": lambda carry, zero: False,
+}
+
+# What a BRNCH that didn't jump tells about the flags, (carry, zero).
+NOT_TAKEN = {"z": (None, False), "nz": (None, True),
+             "c": (False, None), "nc": (True, None)}
+
+# ALU operations without side effects besides their destination register.
+PURE_OPCODES = ("ADD", "SUB", "RSH", "NOR", "AND", "INC", "DEC")
+
+# Counters reported by optimize().
+OPTIMIZATIONS = ("known condition", "never taken", "dead flags",
+                 "self move", "jump chain", "jump to next")
+
+
+def register(field):
+    """ Register number of an instruction field, None if not known. """
+    try:
+        if isinstance(field, str):
+            return int(field)
+        if field.kind == REG:
+            return int(field.text[1:])
+    except ValueError:
+        pass
+    return None
+
+
+def constant(field):
+    """ Value of an immediate field, None if it depends on the link. """
+    try:
+        if isinstance(field, str):
+            return int(field)
+        if field.kind == IMM:
+            return int(field.text)
+    except ValueError:
+        pass
+    return None
+
+
+def is_label(field):
+    return isinstance(field, Operand) and field.kind == LABEL
+
+
+def branch_target(instruction):
+    """ Label name a direct BRNCH jumps to, None for indirect ones. """
+    _, _, src_b, imm, _ = instruction.fields
+    if instruction.opcode == "BRNCH" and register(src_b) == 0 \
+            and is_label(imm):
+        return imm.text
+    return None
+
+
+def has_absolute_jumps(instructions):
+    """ True when some BRNCH goes to a numeric address. """
+    return any(ins.opcode == "BRNCH" and register(ins.fields[2]) == 0
+               and not is_label(ins.fields[3]) and ins.fields[4] != "1"
+               for ins in instructions)
+
+
+def flag_writes(instruction):
+    return FLAG_WRITES.get(instruction.opcode, 0)
+
+
+def flag_reads(instruction):
+    if instruction.opcode == "BRNCH":
+        return FLAG_READS[instruction.fields[4]]
+    return 0
+
+
+def only_sets_flags(instruction):
+    """ True for ALU instructions that leave every register as it was:
+    results written to R0 and ADD/SUB of a register and 0 to itself. """
+    if instruction.opcode not in PURE_OPCODES:
+        return False
+    dest, src_a, src_b, imm, _ = instruction.fields
+    if register(dest) == 0:
+        return True
+    return instruction.opcode in ("ADD", "SUB") \
+        and register(dest) is not None and register(dest) == register(src_a) \
+        and register(src_b) == 0 and constant(imm) == 0
+
+
+class FlowGraph():
+    """ Control flow and flag state of linked code.
+
+    succ[addr] lists where execution can go after addr, len(instructions)
+    standing for running off the end. live_out[addr] are the flags that
+    may be read after addr, known[addr] the (carry, zero) values before
+    it, None where they aren't known.
+    """
+    def __init__(self, instructions, labels, bits=8):
+        self.instructions = instructions
+        self.alu = ALU(bits, tables=False)
+        self.targets = set(labels.values())
+        indirect = set()
+        for ins in instructions:
+            for pos, field in enumerate(ins.fields):
+                if is_label(field) and field.text in labels \
+                        and not (ins.opcode == "BRNCH" and pos == 3):
+                    indirect.add(labels[field.text])
+        self.succ = [self.successors(addr, labels, indirect)
+                     for addr in range(len(instructions))]
+        self.live_out = self.flag_liveness()
+        self.known = self.known_flags()
+
+    def successors(self, addr, labels, indirect):
+        ins = self.instructions[addr]
+        if ins.opcode == "MSC" and ins.fields[4] == "1":
+            return []
+        if ins.opcode != "BRNCH":
+            return [addr + 1]
+        out = []
+        target = branch_target(ins)
+        if target is not None:
+            if target in labels:
+                out.append(labels[target])
+        elif register(ins.fields[2]) != 0:
+            out += sorted(indirect)
+        if ins.fields[4] != "0":
+            out.append(addr + 1)
+        return out
+
+    def flag_liveness(self):
+        """ Flags that may be read after every instruction. """
+        size = len(self.instructions)
+        live_in = [0] * size
+        live_out = [0] * size
+        changed = True
+        while changed:
+            changed = False
+            for addr in reversed(range(size)):
+                out = 0
+                for succ in self.succ[addr]:
+                    out |= ALL_FLAGS if succ >= size else live_in[succ]
+                ins = self.instructions[addr]
+                new = flag_reads(ins) | out & ~flag_writes(ins)
+                live_out[addr] = out
+                if new != live_in[addr]:
+                    live_in[addr] = new
+                    changed = True
+        return live_out
+
+    def known_flags(self):
+        """ (carry, zero) known before every instruction. Only straight
+        fall-through is followed, anything a branch can land on starts
+        out unknown. """
+        known = []
+        state = (None, None)
+        for addr, ins in enumerate(self.instructions):
+            if addr == 0 or addr in self.targets \
+                    or addr not in self.succ[addr - 1]:
+                state = (None, None)
+            known.append(state)
+            state = self.transfer(ins, state)
+        return known
+
+    def transfer(self, instruction, state):
+        """ Flag values after instruction, when it falls through. """
+        opcode = instruction.opcode
+        _, src_a, src_b, imm, cnd = instruction.fields
+        if opcode in ("ADD", "SUB"):
+            if register(src_a) != 0 or register(src_b) != 0 \
+                    or constant(imm) is None:
+                return (None, None)
+            op = self.alu.add_ if opcode == "ADD" else self.alu.sub_
+            _, carry, zero = op(0, constant(imm))
+            return (bool(carry), bool(zero))
+        if opcode == "RSH":
+            if register(src_a) != 0:
+                return (None, state[1])
+            return (bool(self.alu.rsh_(0)[1]), state[1])
+        if opcode == "BRNCH" and cnd in NOT_TAKEN:
+            carry, zero = NOT_TAKEN[cnd]
+            return (state[0] if carry is None else carry,
+                    state[1] if zero is None else zero)
+        return state
+
+    def condition(self, addr):
+        """ Whether the BRNCH at addr jumps, None if not known. """
+        cnd = self.instructions[addr].fields[4]
+        carry, zero = self.known[addr]
+        reads = FLAG_READS[cnd]
+        if reads & CARRY and carry is None or reads & ZERO and zero is None:
+            return None
+        return bool(PREDICATES[cnd](carry, zero))
+
+
+def follow_jumps(name, labels, instructions):
+    """ Final label of a chain of unconditional jumps starting at name. """
+    seen = {name}
+    while labels.get(name, len(instructions)) < len(instructions):
+        ins = instructions[labels[name]]
+        target = branch_target(ins)
+        if ins.fields[4] != "0" or target is None or target in seen:
+            break
+        seen.add(target)
+        name = target
+    return name
+
+
+def optimize_pass(code, counts, bits=8):
+    """ One round of rewrites, returns (code, number of changes). """
+    instructions, labels, _ = link(code)
+    graph = FlowGraph(instructions, labels, bits)
+    replaced = {}
+    for addr, ins in enumerate(instructions):
+        if ins.opcode == "BRNCH":
+            target = branch_target(ins)
+            if target is not None and labels.get(target) == addr + 1:
+                replaced[id(ins)] = None
+                counts["jump to next"] += 1
+                continue
+            taken = graph.condition(addr)
+            if taken is False:
+                replaced[id(ins)] = None
+                counts["never taken"] += 1
+                continue
+            fields = list(ins.fields)
+            if taken and fields[4] != "0":
+                fields[4] = "0"
+                counts["known condition"] += 1
+            if target is not None:
+                final = follow_jumps(target, labels, instructions)
+                if final != target:
+                    fields[3] = Operand(final)
+                    counts["jump chain"] += 1
+            if fields != ins.fields:
+                replaced[id(ins)] = AsmInstruction("BRNCH", fields,
+                                                   ins.location)
+        elif only_sets_flags(ins) \
+                and not flag_writes(ins) & graph.live_out[addr]:
+            replaced[id(ins)] = None
+            if register(ins.fields[0]) == 0:
+                counts["dead flags"] += 1
+            else:
+                counts["self move"] += 1
+
+    if not replaced:
+        return code, 0
+    out = []
+    for item in code:
+        if isinstance(item, AsmInstruction) and id(item) in replaced:
+            item = replaced[id(item)]
+            if item is None:
+                continue
+        out.append(item)
+    return out, len(replaced)
+
+
+def optimize(code, bits=8):
+    """ Optimize expanded code. Returns (code, counts), counts maps
+    OPTIMIZATIONS to how often each was applied. """
+    counts = dict.fromkeys(OPTIMIZATIONS, 0)
+    instructions, _, _ = link(code)
+    if has_absolute_jumps(instructions):
+        return code, counts
+    changes = True
+    while changes:
+        code, changes = optimize_pass(code, counts, bits)
+    return code, counts
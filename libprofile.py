@@ -0,0 +1,240 @@
+""" Per-address profiler for DRC v.2 programs.
+
+Profiler is a step hook counting, for every ROM address, how often the
+instruction there executed and how many clock ticks it spent stalled
+waiting for a device. The counters are preallocated lists indexed by PC,
+and nothing is installed unless profiling is enabled, so the fast run()
+loop is untouched otherwise.
+
+profile_report() maps the counts back to the .s source lines and labels
+the ROM was compiled from, or those in the symbol table of a .drb ROM,
+as a JSON friendly dict, format_report() turns that into text. A source
+only annotates the report when it still compiles to the profiled ROM.
+"""
+import os
+from collections import namedtuple
+
+from libcompiler import compile_file, read_source, CompileError
+from libcpu import EMPTY_INSTRUCTION, decode_instruction
+from librom import is_rom_image, read_rom
+
+
+SourceLine = namedtuple("SourceLine", "file line text")
+
+
+class Profiler():
+    """ Step hook counting executions and stall ticks per address. """
+    def __init__(self, system):
+        self.system = system
+        self.executions = [0] * len(system.program)
+        self.stalls = [0] * len(system.program)
+
+    def reset(self):
+        """ Zero all counters. """
+        size = len(self.system.program)
+        self.executions = [0] * size
+        self.stalls = [0] * size
+
+    def before(self, pc, instruction):
+        pass
+
+    def after(self, pc, instruction):
+        if self.system.status_reg["wait_bit"]:
+            self.stalls[pc] += 1
+        else:
+            self.executions[pc] += 1
+
+    def cycles(self, pc):
+        """ Clock ticks spent at pc, executing or stalled. """
+        return self.executions[pc] + self.stalls[pc]
+
+
+def source_map(filename, libdir=None, strip=True, optimize=False,
+               word_size=8, program=None):
+    """ Compile filename and keep track of where every instruction came
+    from.
+
+    Returns (lines, labels): lines[addr] is the SourceLine that produced
+    the instruction at addr, labels maps the labels written in the sources
+    to their address. libdir defaults to the directory of filename, strip,
+    optimize and word_size have to match how the ROM was compiled.
+    program is the decoded ROM that is loaded, if given a ValueError is
+    raised when filename doesn't compile to it, e.g. for a stale ROM.
+    """
+    if libdir is None:
+        libdir = os.path.dirname(filename)
+    compiled = compile_file(filename, libdir, strip=strip, optimize=optimize,
+                            word_size=word_size)
+    if program is not None and not matches_rom(compiled.lines, program):
+        raise ValueError(f"{filename} doesn't compile to the loaded ROM, "
+                         f"recompile it")
+    return source_lines(compiled.locations), compiled.source_labels
+
+
+def matches_rom(lines, program):
+    """ True when the .a lines are the instructions of the decoded ROM
+    program, followed by nothing but its empty padding. """
+    if len(lines) > len(program):
+        return False
+    decoded = [decode_instruction(line.split(), addr)
+               for addr, line in enumerate(lines)]
+    return program[:len(decoded)] == decoded \
+        and all(ins == EMPTY_INSTRUCTION for ins in program[len(decoded):])
+
+
+def guess_source(rom):
+    """ The .s file next to a text ROM, None if there is none or rom is
+    a .drb that carries its own symbols. """
+    if is_rom_image(rom):
+        return None
+    guess = os.path.splitext(rom)[0] + ".s"
+    return guess if os.path.exists(guess) else None
+
+
+def rom_labels(rom, program, source=None, libdir=None, optimize=False,
+               word_size=8):
+    """ Source labels of rom, loaded as the decoded program, by name: from
+    its source if given or found next to it, otherwise from its symbol
+    table. Empty when neither is there, ValueError when the source
+    doesn't compile to program. """
+    source = source or guess_source(rom)
+    if source:
+        return source_map(source, libdir, optimize=optimize,
+                          word_size=word_size, program=program)[1]
+    return rom_map(rom)[1]
+
+
+def rom_map(filename):
+    """ (lines, labels) like source_map() from the symbol table of a .drb
+    ROM, empty for ROMs without one. """
+    if not is_rom_image(filename):
+        return [], {}
+    image = read_rom(filename)
+    return source_lines(image.locations), image.labels
+
+
+def source_lines(locations):
+    """ SourceLine of every (file, line) in locations, None where that
+    isn't known. The text is empty when the file is gone. """
+    texts = {}
+    lines = []
+    for location in locations:
+        if location is None:
+            lines.append(None)
+            continue
+        name, line_no = location
+        if name not in texts:
+            try:
+                texts[name] = read_source(name)
+            except CompileError:
+                texts[name] = []
+        text = texts[name][line_no - 1].strip() \
+            if line_no <= len(texts[name]) else ""
+        lines.append(SourceLine(name, line_no, text))
+    return lines
+
+
+def label_of(addr, labels):
+    """ (label, offset) of the closest source label at or before addr, the
+    last one written when several share an address. """
+    best = None, addr
+    for label, label_addr in labels.items():
+        if label_addr <= addr and (best[0] is None
+                                   or label_addr >= labels[best[0]]):
+            best = label, addr - label_addr
+    return best
+
+
+def profile_report(profiler, source=None, libdir=None, optimize=False,
+                   rom=None, word_size=8):
+    """ Profile as a dict: totals, per label and per address counts.
+    source is the .s file the ROM was compiled from, if known, optimize
+    tells whether it went through the optimizer. Without a source the
+    symbol table of a .drb rom is used, if it has one. A source that
+    doesn't compile to the profiled ROM is left out, the report then has
+    raw addresses only and a "warning" saying why. """
+    lines, labels = [], {}
+    warning = None
+    if source:
+        try:
+            lines, labels = source_map(source, libdir, optimize=optimize,
+                                       word_size=word_size,
+                                       program=profiler.system.program)
+        except ValueError as err:
+            warning = str(err)
+            source = None
+    elif rom:
+        lines, labels = rom_map(rom)
+    total = sum(profiler.executions) + sum(profiler.stalls)
+
+    addresses = []
+    by_label = {}
+    for pc in range(len(profiler.executions)):
+        cycles = profiler.cycles(pc)
+        if not cycles:
+            continue
+        label, offset = label_of(pc, labels)
+        entry = {
+            "addr": pc,
+            "executions": profiler.executions[pc],
+            "stalls": profiler.stalls[pc],
+            "cycles": cycles,
+            "share": cycles / total,
+            "label": label,
+            "offset": offset,
+        }
+        if pc < len(lines) and lines[pc] is not None:
+            entry["file"] = os.path.basename(lines[pc].file)
+            entry["line"] = lines[pc].line
+            entry["source"] = lines[pc].text
+        addresses.append(entry)
+
+        counts = by_label.setdefault(label, [0, 0, 0])
+        counts[0] += profiler.executions[pc]
+        counts[1] += profiler.stalls[pc]
+        counts[2] += cycles
+
+    label_rows = [{"label": label,
+                   "addr": labels.get(label),
+                   "executions": executions,
+                   "stalls": stalls,
+                   "cycles": cycles,
+                   "share": cycles / total}
+                  for label, (executions, stalls, cycles) in by_label.items()]
+    label_rows.sort(key=lambda row: (-row["cycles"], str(row["label"])))
+
+    return {
+        "source": source,
+        "warning": warning,
+        "cycles": total,
+        "executions": sum(profiler.executions),
+        "stalls": sum(profiler.stalls),
+        "labels": label_rows,
+        "addresses": addresses,
+    }
+
+
+def format_report(report, top=20):
+    """ Text form of a profile_report(), hottest labels and addresses. """
+    out = [f"{report['cycles']} cycles: {report['executions']} executed, "
+           f"{report['stalls']} stalled"]
+    if report.get("warning"):
+        out.append(f"warning: {report['warning']}, addresses only")
+    out += ["",
+            f"{'label':<24} {'cycles':>10} {'share':>7} {'stalls':>8}"]
+    for row in report["labels"]:
+        out.append(f"{row['label'] or '(no label)':<24} {row['cycles']:>10} "
+                   f"{row['share']:>7.1%} {row['stalls']:>8}")
+
+    out += ["", f"{'addr':>4} {'cycles':>10} {'share':>7} {'stalls':>8}  "
+                f"{'location':<24} source"]
+    hottest = sorted(report["addresses"],
+                     key=lambda row: (-row["cycles"], row["addr"]))[:top]
+    for row in hottest:
+        where = f"{row['label']}+{row['offset']}" if row["label"] else ""
+        source = f"{row['file']}:{row['line']}  {row['source']}" \
+            if "source" in row else ""
+        out.append(f"{row['addr']:>4} {row['cycles']:>10} "
+                   f"{row['share']:>7.1%} {row['stalls']:>8}  "
+                   f"{where:<24} {source}")
+    return "\n".join(out)
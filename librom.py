@@ -0,0 +1,192 @@
+""" Binary ROM images.
+
+A .drb file is a HEADER, one fixed-size INSTRUCTION record per ROM
+address and, when the HAS_SYMBOLS flag is set, a symbol table:
+
+    u16 file count, then per file a u16 length and the UTF-8 path
+    u16 label count, then per label a u16 address, a u16 length and the
+        UTF-8 name
+    one LOCATION record per instruction: file index, line number
+
+INSTRUCTION fields are laid out in the order of the pre-decoded tuples
+of libcpu, so loading is a single struct.iter_unpack() over the mapped
+file. The text .a format stays the default, libcpu.load_program()
+accepts both.
+"""
+import mmap
+import os
+import struct
+from collections import namedtuple
+
+from libcpu import (OPCODES, CONDITIONS, EMPTY_INSTRUCTION, decode_instruction,
+                    disassemble, read_assembly)
+
+
+ROM_MAGIC = b"DRCB"
+ROM_VERSION = 1
+
+# magic, version, word size, instruction count, flags
+HEADER = struct.Struct("<4sHHHH")
+HAS_SYMBOLS = 1
+
+# opcode, dest, src_a, src_b, immediate, condition, padding
+INSTRUCTION = struct.Struct("<BBBBHBx")
+
+# file index, line number
+LOCATION = struct.Struct("<HI")
+NO_FILE = 0xFFFF
+
+COUNT = struct.Struct("<H")
+
+# Contents of a ROM file: decoded instructions, word size, source labels
+# by name and a (file, line) per instruction, both empty without symbols.
+RomImage = namedtuple("RomImage", "instructions word_size labels locations")
+
+
+def is_rom_image(filename):
+    """ True when filename starts like a binary ROM. """
+    with open(filename, "rb") as f:
+        return f.read(len(ROM_MAGIC)) == ROM_MAGIC
+
+
+def read_rom(filename):
+    """ Read a .drb file into a RomImage. """
+    with open(filename, "rb") as f:
+        size = f.seek(0, 2)
+        if size < HEADER.size:
+            raise ValueError(f"{filename} is not a ROM image")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as rom, \
+                memoryview(rom) as view:
+            return parse_rom(view, filename)
+
+
+def parse_rom(view, filename="ROM"):
+    """ RomImage of the bytes in view. """
+    magic, version, word_size, count, flags = HEADER.unpack_from(view)
+    if magic != ROM_MAGIC or version != ROM_VERSION:
+        raise ValueError(f"{filename} is not a version {ROM_VERSION} "
+                         f"ROM image")
+    end = HEADER.size + count * INSTRUCTION.size
+    if end > len(view):
+        raise ValueError(f"{filename} is truncated")
+    instructions = list(INSTRUCTION.iter_unpack(view[HEADER.size:end]))
+    for addr, (opcode, dest, src_a, src_b, imm, cnd) in \
+            enumerate(instructions):
+        if opcode >= len(OPCODES) or cnd >= len(CONDITIONS) \
+                or max(dest, src_a, src_b) > 7 or imm >= 2**word_size:
+            raise ValueError(f"Malformed instruction at address {addr} "
+                             f"of {filename}")
+
+    labels = {}
+    locations = []
+    if flags & HAS_SYMBOLS:
+        try:
+            files, offset = read_strings(view, end)
+            names, offset = read_strings(view, offset, with_addr=True)
+            labels = dict(names)
+            for file_idx, line in LOCATION.iter_unpack(
+                    view[offset:offset + count * LOCATION.size]):
+                locations.append(None if file_idx == NO_FILE
+                                 else (files[file_idx], line))
+        except (struct.error, IndexError, UnicodeDecodeError):
+            raise ValueError(f"Bad symbol table in {filename}") from None
+    return RomImage(instructions, word_size, labels, locations)
+
+
+def read_strings(view, offset, with_addr=False):
+    """ A counted list of strings, or (string, address) pairs, starting
+    at offset. Returns it and the offset after it. """
+    (count,), offset = COUNT.unpack_from(view, offset), offset + COUNT.size
+    out = []
+    for _ in range(count):
+        if with_addr:
+            (addr,) = COUNT.unpack_from(view, offset)
+            offset += COUNT.size
+        (length,) = COUNT.unpack_from(view, offset)
+        offset += COUNT.size
+        if offset + length > len(view):
+            raise IndexError(offset)
+        text = bytes(view[offset:offset + length]).decode()
+        offset += length
+        out.append((text, addr) if with_addr else text)
+    return out, offset
+
+
+def write_strings(out, strings):
+    out += COUNT.pack(len(strings))
+    for text in strings:
+        data = text.encode()
+        out += COUNT.pack(len(data)) + data
+
+
+def write_rom(filename, instructions, word_size=8, labels=None,
+              locations=None):
+    """ Write decoded instructions as a .drb file. labels maps names to
+    addresses, locations holds a (file, line) or None per instruction;
+    the symbol table is left out when neither is given. """
+    if len(instructions) > 0xFFFF:
+        raise ValueError("Too many instructions for a ROM image")
+    symbols = labels is not None or locations is not None
+    out = bytearray(HEADER.pack(ROM_MAGIC, ROM_VERSION, word_size,
+                                len(instructions),
+                                HAS_SYMBOLS if symbols else 0))
+    for ins in instructions:
+        out += INSTRUCTION.pack(*ins)
+
+    if symbols:
+        locations = locations or [None] * len(instructions)
+        files = sorted({loc[0] for loc in locations if loc is not None})
+        index = {name: idx for idx, name in enumerate(files)}
+        write_strings(out, files)
+        labels = labels or {}
+        out += COUNT.pack(len(labels))
+        for name, addr in labels.items():
+            data = name.encode()
+            out += COUNT.pack(addr) + COUNT.pack(len(data)) + data
+        for loc in locations:
+            out += LOCATION.pack(NO_FILE, 0) if loc is None \
+                else LOCATION.pack(index[loc[0]], loc[1])
+
+    with open(filename, "wb") as f:
+        f.write(out)
+
+
+def rom_program(image, bits=8):
+    """ ROM of 2**bits instructions from a RomImage, as load_program()
+    returns it. """
+    if image.word_size > bits:
+        raise ValueError(f"ROM image is for a {image.word_size} bit system")
+    if len(image.instructions) > 2**bits:
+        raise ValueError(f"ROM image has {len(image.instructions)} "
+                         f"instructions, the ROM holds {2**bits}")
+    program = [EMPTY_INSTRUCTION] * 2**bits
+    program[:len(image.instructions)] = image.instructions
+    return program
+
+
+def save_program(filename, program, word_size=8):
+    """ Write a libcompiler CompiledProgram as a .drb file with symbols. """
+    instructions = [decode_instruction(line.split(), addr)
+                    for addr, line in enumerate(program.lines)]
+    write_rom(filename, instructions, word_size, program.source_labels,
+              [tuple(loc) for loc in program.locations])
+
+
+def read_any(filename, bits=8):
+    """ RomImage of a .drb or .a file, without padding. """
+    if is_rom_image(filename):
+        return read_rom(filename)
+    return RomImage(read_assembly(filename, bits), bits, {}, [])
+
+
+def convert(src, dest, bits=8):
+    """ Convert a ROM between the .a text and the .drb binary format, the
+    extension of dest decides. Binary to text drops the symbol table. """
+    image = read_any(src, bits)
+    if os.path.splitext(dest)[1] == ".drb":
+        write_rom(dest, image.instructions, image.word_size,
+                  image.labels or None, image.locations or None)
+        return
+    with open(dest, "w") as f:
+        for ins in image.instructions:
+            f.write(disassemble(ins) + " \n")
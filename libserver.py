@@ -0,0 +1,215 @@
+""" asyncio server hosting interactive DRC v.2 sessions.
+
+Every connection, over TCP or a Unix socket, gets a session with its own
+DRCv2System whose console is the connection. Sessions run in slices of
+at most slice_cycles cycles and hand the event loop to the others after
+each slice, so no program can starve the rest. A session stalled on
+console input awaits DRCv2System.ready_future() and costs nothing until
+input arrives.
+
+The protocol is line based. Commands:
+
+    load <rom> [word size]  load a .a or .drb file below the server root
+    reset                   restart the loaded ROM
+    run [cycles]            run until halt, or for at most cycles
+    pause                   stop running
+    status                  report state, pc, cycles and seconds waited
+    quit                    close the session
+
+A line of numbers, e.g. "17 5" or "17,5", is console input. The server
+answers every command with "ok" or "error <message>" and sends
+"out <value>" for console output, "wait <device>" when the program
+stalls, "halt <cycles>" when it halts and "paused <cycles>" when a run
+ends otherwise.
+
+    python -m drc serve --port 7000 --root programs/
+"""
+import asyncio
+import os
+
+from libcpu import (DRCv2System, Console, load_program, CONSOLE_ADDR,
+                    WORD_SIZES, EXIT_HALT, EXIT_WAIT)
+
+
+# Cycles a session runs before the other sessions get a turn.
+SLICE_CYCLES = 10000
+
+
+class StreamConsole(Console):
+    """ Console that also collects its output for the session to send. """
+    def __init__(self, bits=8):
+        super().__init__(bits=bits)
+        self.outbox = []
+
+    def write(self, val):
+        super().write(val)
+        self.outbox.append(self.buffer[0])
+
+
+def resolve_rom(root, name):
+    """ Path of ROM name below root, ValueError when it points outside. """
+    root = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(root, name))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError(f"{name} is outside of the server root")
+    return path
+
+
+def parse_input(text):
+    """ Console input values of a line like "17 5" or "17,5". """
+    try:
+        return [int(val) for val in text.replace(",", " ").split()]
+    except ValueError:
+        raise ValueError(f"expected integers, got {text!r}") from None
+
+
+class Session():
+    """ One connection and the system it drives. """
+    def __init__(self, reader, writer, root=".", slice_cycles=SLICE_CYCLES,
+                 engine="interpreter"):
+        self.reader = reader
+        self.writer = writer
+        self.root = root
+        self.slice_cycles = slice_cycles
+        self.engine = engine
+        self.rom = None
+        self.word_size = 8
+        self.system = None
+        self.budget = None
+        self.task = None
+
+    def send(self, *words):
+        self.writer.write((" ".join(str(word) for word in words)
+                           + "\n").encode())
+
+    async def serve(self):
+        """ Handle commands until the client quits or disconnects. """
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                try:
+                    if not self.handle(line.decode().strip()):
+                        break
+                except (OSError, ValueError) as err:
+                    self.send("error", err)
+                await self.writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.pause()
+            self.writer.close()
+
+    def handle(self, line):
+        """ Execute one command line, False once the session should end. """
+        if not line:
+            return True
+        if line[0].isdigit():
+            self.require_system().devices[CONSOLE_ADDR].feed(
+                parse_input(line))
+            return True
+        command, *args = line.split()
+        if command == "quit":
+            return False
+        if command == "load":
+            if not 1 <= len(args) <= 2:
+                raise ValueError("usage: load <rom> [word size]")
+            word_size = int(args[1]) if len(args) > 1 else 8
+            if word_size not in WORD_SIZES:
+                raise ValueError(f"Unsupported word size: {word_size}")
+            self.rom = resolve_rom(self.root, args[0])
+            self.word_size = word_size
+            self.reset()
+        elif command == "reset":
+            self.require_system()
+            self.reset()
+        elif command == "run":
+            self.require_system()
+            self.budget = int(args[0]) if args else None
+            if self.task is None or self.task.done():
+                self.task = asyncio.ensure_future(self.execute())
+        elif command == "pause":
+            self.pause()
+        elif command == "status":
+            system = self.require_system()
+            state = "running" if self.task and not self.task.done() \
+                else "idle"
+            if system.status_reg["halt_bit"]:
+                state = "halted"
+            elif system.status_reg["wait_bit"]:
+                state = "waiting"
+            self.send("status", state, system.program_counter, system.cycles,
+                      f"{system.waited():.3f}")
+            return True
+        else:
+            raise ValueError(f"Unknown command: {command}")
+        self.send("ok")
+        return True
+
+    def require_system(self):
+        if self.system is None:
+            raise ValueError("No ROM loaded")
+        return self.system
+
+    def reset(self):
+        """ Fresh system with the loaded ROM, not running. """
+        self.pause()
+        system = DRCv2System(self.word_size)
+        system.program = load_program(self.word_size, self.rom)
+        system.set_engine(self.engine)
+        system.devices[CONSOLE_ADDR] = StreamConsole(bits=self.word_size)
+        self.system = system
+
+    def pause(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def flush(self, console):
+        """ Send the console output of the last slice. """
+        for val in console.outbox:
+            self.send("out", val)
+        console.outbox.clear()
+
+    async def execute(self):
+        """ Run the system in slices until it halts or the budget of the
+        run command is used up, sleeping through console waits. """
+        system = self.system
+        console = system.devices[CONSOLE_ADDR]
+        while True:
+            if self.budget == 0:
+                self.send("paused", system.cycles)
+                return
+            cycles = self.slice_cycles if self.budget is None \
+                else min(self.slice_cycles, self.budget)
+            reason, done = system.run(max_cycles=cycles)
+            if self.budget is not None:
+                self.budget -= done
+            self.flush(console)
+            if reason == EXIT_HALT:
+                self.send("halt", system.cycles)
+                return
+            if reason == EXIT_WAIT:
+                self.send("wait", system.wait_device())
+                await self.writer.drain()
+                await asyncio.wrap_future(system.ready_future())
+            else:
+                # Backpressure from slow clients, and a turn for the others.
+                await self.writer.drain()
+                await asyncio.sleep(0)
+
+
+async def serve(host="127.0.0.1", port=7000, path=None, root=".",
+                slice_cycles=SLICE_CYCLES, engine="interpreter"):
+    """ Accept sessions on a Unix socket at path, or on host:port, until
+    cancelled. """
+    async def connected(reader, writer):
+        await Session(reader, writer, root, slice_cycles, engine).serve()
+
+    if path is not None:
+        server = await asyncio.start_unix_server(connected, path)
+    else:
+        server = await asyncio.start_server(connected, host, port)
+    async with server:
+        await server.serve_forever()
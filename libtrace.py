@@ -0,0 +1,169 @@
+""" Binary execution traces.
+
+A trace file is a TRACE_HEADER followed by one fixed-size RECORD per
+executed instruction: cycle, pc, opcode, destination register and the
+value it holds afterwards, packed status bits, and for STR the address
+and value written. WRITTEN in the status byte tells STR records apart,
+as every 16 bit address is a valid one. Stalled instructions are not
+recorded. A partial last record, as left by a run that was killed, is
+ignored.
+
+TraceWriter packs records into a preallocated buffer and writes it out
+whenever it fills up, TraceReader maps a file with mmap and unpacks
+records on demand, so neither keeps Python objects per step around.
+"""
+import mmap
+import struct
+from collections import namedtuple
+
+from libcpu import OP_STR, OPCODES
+from libhistory import pack_status, FLAG_VALUES
+
+
+TRACE_MAGIC = b"DRCT"
+TRACE_VERSION = 2
+
+# magic, version, word size
+TRACE_HEADER = struct.Struct("<4sHH")
+
+# cycle, pc, opcode, dest, dest value, status, address, value written
+RECORD = struct.Struct("<QHBBHBHH")
+
+# Status bit of records with an address and value written, pack_status()
+# leaves it clear.
+WRITTEN = 0x80
+
+TraceRecord = namedtuple(
+    "TraceRecord", "cycle pc opcode dest dest_val status addr value")
+
+# Records buffered by TraceWriter before a write.
+BUFFER_RECORDS = 4096
+
+# Records read at once when iterating or diffing.
+READ_CHUNK = 4096
+
+
+class TraceWriter():
+    """ Step hook streaming a trace of every executed instruction. """
+    def __init__(self, system, filename, buffer_records=BUFFER_RECORDS):
+        self.system = system
+        self.file = open(filename, "wb")
+        self.file.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION,
+                                          system.word_size))
+        self.buffer = bytearray(RECORD.size * buffer_records)
+        self.offset = 0
+        self.records = 0
+
+    def before(self, pc, instruction):
+        pass
+
+    def after(self, pc, instruction):
+        system = self.system
+        status = system.status_reg
+        if status["wait_bit"]:
+            return
+        opcode, dest, src_a = instruction[:3]
+        regs = system.registers
+        packed = pack_status(status)
+        if opcode == OP_STR:
+            packed |= WRITTEN
+            addr = system.last_written
+            value = regs[src_a]
+        else:
+            addr = 0
+            value = 0
+        RECORD.pack_into(self.buffer, self.offset, system.cycles - 1, pc,
+                         opcode, dest, regs[dest], packed, addr, value)
+        self.offset += RECORD.size
+        self.records += 1
+        if self.offset == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        """ Write out the buffered records. """
+        self.file.write(memoryview(self.buffer)[:self.offset])
+        self.offset = 0
+
+    def close(self):
+        """ Flush and close the trace file. """
+        self.flush()
+        self.file.close()
+
+
+class TraceReader():
+    """ Random access to the records of a trace file. """
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            size = f.seek(0, 2)
+            if size < TRACE_HEADER.size:
+                raise ValueError(f"{filename} is not a trace file")
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.word_size = TRACE_HEADER.unpack_from(self.map)
+        if magic != TRACE_MAGIC or version != TRACE_VERSION:
+            self.map.close()
+            raise ValueError(f"{filename} is not a version {TRACE_VERSION} "
+                             f"trace file")
+        self.count = (size - TRACE_HEADER.size) // RECORD.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < self.count:
+            raise IndexError(idx)
+        return TraceRecord._make(RECORD.unpack_from(self.map, self.offset(idx)))
+
+    def __iter__(self):
+        for start in range(0, self.count, READ_CHUNK):
+            chunk = self.raw(start, min(start + READ_CHUNK, self.count))
+            for fields in RECORD.iter_unpack(chunk):
+                yield TraceRecord._make(fields)
+
+    def offset(self, idx):
+        """ File offset of record idx. """
+        return TRACE_HEADER.size + idx * RECORD.size
+
+    def raw(self, start, stop):
+        """ Records start to stop as unparsed bytes. """
+        return self.map[self.offset(start):self.offset(stop)]
+
+    def close(self):
+        self.map.close()
+
+
+def diff_traces(reader_a, reader_b, chunk=READ_CHUNK):
+    """ Index of the first record where two traces differ, or of the end
+    of the shorter one. None when both traces are identical. """
+    common = min(len(reader_a), len(reader_b))
+    for start in range(0, common, chunk):
+        stop = min(start + chunk, common)
+        block_a = reader_a.raw(start, stop)
+        block_b = reader_b.raw(start, stop)
+        if block_a != block_b:
+            for idx in range(stop - start):
+                at = idx * RECORD.size
+                if block_a[at:at + RECORD.size] != block_b[at:at + RECORD.size]:
+                    return start + idx
+    if len(reader_a) != len(reader_b):
+        return common
+    return None
+
+
+def format_record(record):
+    """ One line of text for a TraceRecord. """
+    packed = record.status
+    flags = {None: "?", False: "-", True: "1"}
+    status = f"c{flags[FLAG_VALUES[packed & 3]]} " \
+        f"z{flags[FLAG_VALUES[packed >> 2 & 3]]}" \
+        + (" halt" if packed >> 4 & 1 else "")
+    line = f"{record.cycle:8} {record.pc:3}  {OPCODES[record.opcode]:<5} " \
+        f"R{record.dest}={record.dest_val:<3} {status}"
+    if packed & WRITTEN:
+        line += f"  [{record.addr}]={record.value}"
+    return line
@@ -0,0 +1,238 @@
+""" NumPy lockstep engine: many DRC v.2 machines running one ROM.
+
+Every machine executes one instruction per step. Machines are grouped by
+the opcode they are about to execute and each group is updated with masked
+array operations, so divergent branches cost one extra group per step
+rather than one Python loop iteration per machine. Halted machines and
+machines that ran out of console input are retired and skipped.
+
+Example, every modulo for mod_calc.a:
+
+    pairs = [(a, b) for a in range(256) for b in range(1, 256)]
+    vec = VectorSystem(len(pairs), load_program(8, "programs/mod_calc.a"),
+                       inputs=pairs)
+    vec.run()
+    remainders = [vec.outputs(i)[0] for i in range(vec.count)]
+"""
+import numpy as np
+
+from libcpu import (OP_ADD, OP_SUB, OP_RSH, OP_INC, OP_DEC, OP_NOR, OP_AND,
+                    OP_LOD, OP_STR, OP_IMM, OP_MSC, OP_BRNCH,
+                    COND_ALWAYS, COND_Z, COND_NZ, COND_C, COND_NC, COND_NC_NZ,
+                    COND_C_Z, COND_C_NZ, COND_HALT,
+                    CONSOLE_ADDR, RNG_ADDR, heap_start,
+                    EXIT_HALT, EXIT_CYCLES, EXIT_WAIT)
+
+
+class VectorSystem():
+    """ count machines sharing one decoded program.
+
+    inputs is an optional sequence with one sequence of console input
+    values per machine, fed to LOD reads from the console in order.
+    """
+    def __init__(self, count, program, inputs=None, seed=None, word_size=8):
+        self.count = count
+        self.word_size = word_size
+        self.mask = 2**word_size - 1
+        self.heap_start = heap_start(word_size)
+        dtype = np.uint8 if word_size <= 8 else np.uint16
+
+        columns = np.array(program, dtype=np.int64).reshape(-1, 6)
+        (self.op, self.dest, self.src_a,
+         self.src_b, self.imm, self.cnd) = columns.T.copy()
+        self.rom_size = len(columns)
+
+        self.registers = np.zeros((count, 8), dtype=dtype)
+        self.ram = np.zeros((count, 2**word_size - self.heap_start),
+                            dtype=dtype)
+        self.io = np.zeros((count, self.heap_start), dtype=dtype)
+        self.program_counter = np.zeros(count, dtype=np.int64)
+        self.carry = np.zeros(count, dtype=bool)
+        self.zero = np.zeros(count, dtype=bool)
+        self.halted = np.zeros(count, dtype=bool)
+        self.waiting = np.zeros(count, dtype=bool)
+        self.cycles = np.zeros(count, dtype=np.int64)
+        self.rng = np.random.default_rng(seed)
+
+        width = max((len(seq) for seq in inputs), default=0) if inputs else 0
+        self.input = np.zeros((count, width), dtype=np.int64)
+        self.input_len = np.zeros(count, dtype=np.int64)
+        self.input_pos = np.zeros(count, dtype=np.int64)
+        for i, seq in enumerate(inputs or ()):
+            self.input[i, :len(seq)] = seq
+            self.input_len[i] = len(seq)
+
+        self.output = np.zeros((count, 4), dtype=np.int64)
+        self.output_len = np.zeros(count, dtype=np.int64)
+
+    def active(self):
+        """ Indices of machines that can still execute. """
+        return np.flatnonzero(~(self.halted | self.waiting))
+
+    def run(self, max_steps=None):
+        """ Step until every machine is retired or max_steps have passed.
+        Returns the number of lockstep steps taken. """
+        steps = 0
+        while max_steps is None or steps < max_steps:
+            if not self.step():
+                break
+            steps += 1
+        return steps
+
+    def step(self):
+        """ Execute one instruction on every active machine.
+        Returns the number of machines that took part. """
+        idx = self.active()
+        if not idx.size:
+            return 0
+
+        pc = self.program_counter[idx]
+        ops = self.op[pc]
+        next_pc = (pc + 1) % self.rom_size
+        executed = np.ones(idx.size, dtype=bool)
+
+        for opcode in np.unique(ops):
+            sel = ops == opcode
+            machines = idx[sel]
+            ins_pc = pc[sel]
+            if opcode == OP_BRNCH:
+                next_pc[sel] = self.exec_brnch(machines, ins_pc)
+            elif opcode == OP_MSC:
+                halt = self.cnd[ins_pc] == COND_HALT
+                self.halted[machines[halt]] = True
+                next_pc[np.flatnonzero(sel)[halt]] = ins_pc[halt]
+            elif opcode == OP_LOD:
+                stalled = self.exec_lod(machines, ins_pc)
+                where = np.flatnonzero(sel)[stalled]
+                next_pc[where] = ins_pc[stalled]
+                executed[where] = False
+            elif opcode == OP_STR:
+                self.exec_str(machines, ins_pc)
+            else:
+                self.exec_alu(opcode, machines, ins_pc)
+
+        self.registers[:, 0] = 0
+        self.program_counter[idx] = next_pc
+        self.cycles[idx[executed]] += 1
+        return idx.size
+
+    def operands(self, machines, pc):
+        """ Value of src_a and of imm | src_b for the given machines. """
+        regs = self.registers
+        val_a = regs[machines, self.src_a[pc]].astype(np.int64)
+        val_b = self.imm[pc] | regs[machines, self.src_b[pc]]
+        return val_a, val_b
+
+    def exec_alu(self, opcode, machines, pc):
+        """ Register-to-register instructions. """
+        val_a, val_b = self.operands(machines, pc)
+        dest = self.dest[pc]
+        size = self.mask + 1
+
+        if opcode == OP_ADD or opcode == OP_SUB:
+            if opcode == OP_SUB:
+                val_b = size - val_b
+            total = val_a + val_b
+            result = total & self.mask
+            self.carry[machines] = total >= size
+            if opcode == OP_ADD:
+                self.zero[machines] = total == 0
+            else:
+                self.zero[machines] = result == 0
+        elif opcode == OP_RSH:
+            result = val_a >> 1
+            self.carry[machines] = (val_a & 1).astype(bool)
+        elif opcode == OP_INC:
+            result = (val_a + 1) & self.mask
+        elif opcode == OP_DEC:
+            result = (val_a - 1) & self.mask
+        elif opcode == OP_NOR:
+            result = ~(val_a | val_b) & self.mask
+        elif opcode == OP_AND:
+            result = val_a & self.registers[machines, self.src_b[pc]]
+        elif opcode == OP_IMM:
+            result = self.imm[pc]
+        else:
+            return
+        self.registers[machines, dest] = result
+
+    def exec_lod(self, machines, pc):
+        """ Loads, returns a mask of machines stalled on the console. """
+        addr = self.imm[pc] | self.registers[machines, self.src_b[pc]]
+        dest = self.dest[pc]
+        stalled = np.zeros(machines.size, dtype=bool)
+
+        ram = addr >= self.heap_start
+        self.registers[machines[ram], dest[ram]] = \
+            self.ram[machines[ram], addr[ram] - self.heap_start]
+
+        rng = addr == RNG_ADDR
+        self.registers[machines[rng], dest[rng]] = \
+            self.rng.integers(0, self.mask + 1, size=int(rng.sum()))
+
+        cons = addr == CONSOLE_ADDR
+        if cons.any():
+            who = machines[cons]
+            pos = self.input_pos[who]
+            ready = pos < self.input_len[who]
+            self.registers[who[ready], dest[cons][ready]] = \
+                self.input[who[ready], pos[ready]]
+            self.input_pos[who[ready]] += 1
+            self.waiting[who[~ready]] = True
+            stalled[np.flatnonzero(cons)[~ready]] = True
+
+        other = ~(ram | rng | cons)
+        self.registers[machines[other], dest[other]] = \
+            self.io[machines[other], addr[other]]
+        return stalled
+
+    def exec_str(self, machines, pc):
+        """ Stores to RAM, device latches and the console. """
+        addr = self.imm[pc] | self.registers[machines, self.src_b[pc]]
+        value = self.registers[machines, self.src_a[pc]]
+
+        ram = addr >= self.heap_start
+        self.ram[machines[ram], addr[ram] - self.heap_start] = value[ram]
+
+        cons = addr == CONSOLE_ADDR
+        if cons.any():
+            who = machines[cons]
+            pos = self.output_len[who]
+            if pos.max() >= self.output.shape[1]:
+                grown = np.zeros((self.count, 2 * self.output.shape[1]),
+                                 dtype=self.output.dtype)
+                grown[:, :self.output.shape[1]] = self.output
+                self.output = grown
+            self.output[who, pos] = value[cons]
+            self.output_len[who] += 1
+
+        other = ~(ram | cons) & (addr != RNG_ADDR)
+        self.io[machines[other], addr[other]] = value[other]
+
+    def exec_brnch(self, machines, pc):
+        """ Branches, returns the next PC of every machine. """
+        cnd = self.cnd[pc]
+        zero = self.zero[machines]
+        carry = self.carry[machines]
+        taken = np.select(
+            [cnd == COND_ALWAYS, cnd == COND_Z, cnd == COND_NZ,
+             cnd == COND_C, cnd == COND_NC, cnd == COND_NC_NZ,
+             cnd == COND_C_Z, cnd == COND_C_NZ],
+            [True, zero, ~zero, carry, ~carry, ~carry & ~zero,
+             carry & zero, carry & ~zero],
+            default=False)
+        target = self.imm[pc] | self.registers[machines, self.src_b[pc]]
+        return np.where(taken, target % self.rom_size,
+                        (pc + 1) % self.rom_size)
+
+    def exit_reason(self, idx):
+        """ EXIT_* reason of machine idx after run(). """
+        if self.halted[idx]:
+            return EXIT_HALT
+        if self.waiting[idx]:
+            return EXIT_WAIT
+        return EXIT_CYCLES
+
+    def outputs(self, idx):
+        """ Values machine idx wrote to the console, oldest first. """
+        return self.output[idx, :self.output_len[idx]].tolist()